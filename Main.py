@@ -1,16 +1,39 @@
-import discord, os, glob, re, json, logging
-from typing import Any
+import time
+startup_started = time.perf_counter()
+
+import discord, asyncio, ast, inspect, os, sys, glob, re, json, logging, random, subprocess, io, math, builtins
+from collections import deque, ChainMap, OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, TYPE_CHECKING
 from discord.ext import tasks
 from dotenv import load_dotenv
 from ruamel.yaml import YAML, constructor
 from datetime import datetime, timedelta, timezone
-import emoji as emojilib
+
+# Only needed by opt-in features, which import them when they are configured
+if TYPE_CHECKING:
+    import cProfile, pstats
+    from concurrent.futures import ProcessPoolExecutor
+    from discord import app_commands
 
 
 logging.basicConfig(filename="bot.log", encoding="utf-8", format="%(asctime)s - %(levelname)s: %(message)s", level=logging.DEBUG)
 logging.info("Startup")
 
 
+# Time spent in each phase of the startup, printed by --startup-report
+startup_phases: dict[str, float] = {}
+phase_started: float = startup_started
+
+def end_phase(name: str) -> None:
+    global phase_started
+    now = time.perf_counter()
+    startup_phases[name] = now - phase_started
+    phase_started = now
+    logging.info("Startup phase '%s' took %.3fs", name, startup_phases[name])
+
+
 def utcnow() -> datetime:
     logging.debug("Retreived UTC time")
     return datetime.now(timezone.utc)
@@ -49,6 +72,12 @@ def string_to_timedelta(string: str) -> timedelta:
     logging.debug("Converted string to timedelta: '%s' -> %s", string, result)
     return result
 
+# Durations can be a number of seconds or a string like '1m 30s'
+def to_seconds(value: Any) -> float:
+    if not value: return None
+    if isinstance(value, (int, float)): return float(value)
+    return string_to_timedelta(str(value)).total_seconds() or None
+
 # https://discord.com/developers/docs/reference#message-formatting-timestamp-styles
 def timestamp(dt: datetime, mode: str = "") -> str:
     result: str = ""
@@ -57,6 +86,24 @@ def timestamp(dt: datetime, mode: str = "") -> str:
     logging.debug("Converted datetime to timestamp: %s -> %s", dt, result)
     return result
 
+# YAML keys can be written with spaces or underscores
+def yaml_get(data: dict, key: str, default: Any = None) -> Any:
+    if not isinstance(data, dict): return default
+    for variant in [key, key.replace(" ", "_")]:
+        if variant in data: return data[variant]
+    return default
+
+# The emoji package builds its whole database on import, so it is only loaded once an emoji needs checking
+def is_emoji(value: str) -> bool:
+    import emoji
+    return emoji.is_emoji(value)
+
+end_phase("imports")
+
+
+
+
+
 # ---------- Load Token ---------- #
 
 load_dotenv()
@@ -105,6 +152,7 @@ if not isinstance(yaml, dict):
 
 print(f"Executing {path}")
 logging.info("Executing: %s", path)
+end_phase("yaml")
 
 
 
@@ -113,27 +161,240 @@ logging.info("Executing: %s", path)
 
 # ---------- Assign Intents ---------- #
 
-intents = discord.Intents.default()
-
-if "intents" in yaml:
+def has_section(name: str, data: dict = None) -> bool:
+    if data is None: data = yaml
+    return name in data or name.replace(" ", "_") in data
+
+# Intents each event section needs on top of 'guilds'
+EVENT_INTENTS: dict[str, list[str]] = {
+    "on connected": [],
+    "on message": ["guild_messages", "dm_messages"],
+    "on user joined": ["members"],
+    "on user left": ["members"],
+}
+
+def walk_yaml(node: Any, key: str = None):
+    yield key, node
+    if isinstance(node, dict):
+        for k, v in node.items(): yield from walk_yaml(v, str(k))
+    elif isinstance(node, list):
+        for v in node: yield from walk_yaml(v, key)
+
+def is_name_lookup(value: Any) -> bool:
+    if not isinstance(value, str): return False
+    value = value.removeprefix("@")
+    if value.lower() == "user" or value.isdigit(): return False
+    var = value.replace(" ", "_")
+    declared = yaml.get("variables") or {}
+    if var in declared: return is_name_lookup(declared[var])
+    return True
+
+def infer_intents() -> discord.Intents:
+    logging.info("Inferring intents")
+    inferred = discord.Intents.none()
+    # Guilds are needed for the guild, channel and role caches
+    inferred.guilds = True
+
+    for section, needed in EVENT_INTENTS.items():
+        if not has_section(section): continue
+        for intent in needed:
+            logging.debug("'%s' needs intent: %s", section, intent)
+            setattr(inferred, intent, True)
+
+    for key, value in walk_yaml(yaml):
+        if key == "target" and is_name_lookup(value) and not inferred.members:
+            logging.debug("Name based user lookup needs the member cache: %s", value)
+            inferred.members = True
+        if key == "emoji" and isinstance(value, str) and not inferred.emojis_and_stickers and not is_emoji(value):
+            logging.debug("Custom emoji lookup needs emojis: %s", value)
+            inferred.emojis_and_stickers = True
+
+    logging.info("Inferred intents: %s", [name for name, enabled in inferred if enabled])
+    return inferred
+
+def report_intents(used: discord.Intents, needed: discord.Intents) -> None:
+    used_flags = dict(iter(used))
+    needed_flags = dict(iter(needed))
+    over = [name for name in used_flags if used_flags[name] and not needed_flags[name]]
+    under = [name for name in used_flags if needed_flags[name] and not used_flags[name]]
+    if over: logging.warning("Subscribed to intents that are not used: %s", over)
+    if under:
+        logging.warning("Missing intents that the YAML needs: %s", under)
+        print(f"Warning: missing intents that the YAML needs: {under}")
+
+
+intents = infer_intents()
+intent_setting = yaml.get("intents", "auto")
+
+if intent_setting == "auto":
+    logging.info("Using inferred intents")
+else:
     logging.info("Setting intents")
-    if not isinstance(yaml["intents"], list):
-        logging.critical("Intents are of type '%s' and not 'list'", type(yaml["intents"]))
-        raise TypeError("Intents must be a list of strings.")
+    if not isinstance(intent_setting, list):
+        logging.critical("Intents are of type '%s' and not 'list'", type(intent_setting))
+        raise TypeError("Intents must be 'auto' or a list of strings.")
 
-    for intent in yaml["intents"]:
+    needed_intents = intents
+    intents = discord.Intents.default()
+    for intent in intent_setting:
         logging.info("Enabling intent: %s", intent)
         if not isinstance(intent, str):
             logging.critical("Intent is not string")
             raise TypeError("Intents must be string values")
-        if not hasattr(intents, intent):
+        if intent not in discord.Intents.VALID_FLAGS:
             logging.critical("Intent is invalid")
             raise ValueError(f"'{intent}' is not a valid intent.")
-        exec(f"intents.{intent} = True")
+        setattr(intents, intent, True)
     logging.info("Finished setting intents")
-else: logging.info("YAML does not contain intents")
+    report_intents(intents, needed_intents)
+
+
+
+
+
+
+# ---------- Cache Policy ---------- #
+
+def cache_options(cache: dict, intents: discord.Intents) -> dict:
+    # Without a cache section the bot caches like discord.py does by default
+    if cache is None:
+        logging.info("No cache policy, using the defaults of discord.py")
+        return {
+            "max_messages": 1000,
+            "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+            "chunk_guilds_at_startup": intents.members
+        }
+
+    logging.info("Setting cache policy: %s", cache)
+    if not isinstance(cache, dict):
+        logging.critical("Cache is of type '%s' and not 'dict'", type(cache))
+        raise TypeError("Cache must be a dictionary.")
+
+    # Nothing in the YAML reads the message cache, so it is off unless asked for
+    max_messages = cache.get("messages", 0)
+    if max_messages is not None and not isinstance(max_messages, int):
+        logging.critical("Message cache size is not an integer")
+        raise TypeError("Cache 'messages' must be a number.")
+
+    members = cache.get("members", "auto")
+    if members == "auto": member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+    elif members == "all": member_cache_flags = discord.MemberCacheFlags.all()
+    elif members == "none" or not members: member_cache_flags = discord.MemberCacheFlags.none()
+    elif isinstance(members, list):
+        member_cache_flags = discord.MemberCacheFlags.none()
+        for flag in members:
+            if flag not in discord.MemberCacheFlags.VALID_FLAGS:
+                logging.critical("Invalid member cache flag: %s", flag)
+                raise ValueError(f"'{flag}' is not a valid member cache flag.")
+            setattr(member_cache_flags, flag, True)
+    else:
+        logging.critical("Member cache is of type '%s'", type(members))
+        raise TypeError("Cache 'members' must be 'auto', 'all', 'none' or a list of flags.")
+
+    options = {
+        "max_messages": max_messages or None,
+        "member_cache_flags": member_cache_flags,
+        "chunk_guilds_at_startup": bool(yaml_get(cache, "chunk at startup", False))
+    }
+    logging.info("Cache options: %s", options)
+    return options
+
+
+cache_policy: dict = yaml.get("cache") or {}
+client_options: dict = cache_options(yaml.get("cache"), intents)
+lazy_chunking: bool = bool(yaml_get(cache_policy, "lazy chunking", True))
+
+
+
 
-client = discord.Client(intents=intents)
+
+
+# ---------- Sharding ---------- #
+
+# Cluster workers are started with the shards they own in the environment
+SHARD_IDS_ENV = "DISCORD_YAML_SHARD_IDS"
+SHARD_COUNT_ENV = "DISCORD_YAML_SHARD_COUNT"
+
+sharding: dict = yaml_get(yaml, "sharding", {})
+if sharding is True: sharding = {"mode": "auto"}
+if not isinstance(sharding, dict):
+    logging.critical("Sharding is of type '%s' and not 'dict'", type(sharding))
+    raise TypeError("Sharding must be a dictionary.")
+
+sharding_mode: str = str(sharding.get("mode", "auto" if sharding else "none")).lower()
+if sharding_mode not in ["none", "auto", "cluster"]:
+    logging.critical("Invalid sharding mode: %s", sharding_mode)
+    raise ValueError(f"'{sharding_mode}' is not a valid sharding mode. Use 'none', 'auto' or 'cluster'.")
+
+shard_count: int = yaml_get(sharding, "shards", yaml_get(sharding, "shard count"))
+if shard_count is not None:
+    try:
+        shard_count = int(shard_count)
+    except (TypeError, ValueError):
+        logging.critical("Invalid shard count: %s", shard_count)
+        raise ValueError(f"'{shard_count}' is not a valid shard count.")
+shard_ids: list[int] = None
+worker_processes: int = 1
+
+if sharding_mode == "cluster":
+    worker_processes = int(sharding.get("processes", 2))
+    if not shard_count: shard_count = worker_processes
+    if worker_processes < 1 or shard_count < worker_processes:
+        logging.critical("Invalid cluster: %s shards on %s processes", shard_count, worker_processes)
+        raise ValueError("A cluster needs at least one process and at least one shard per process.")
+
+if os.getenv(SHARD_IDS_ENV):
+    shard_ids = [int(x) for x in os.environ[SHARD_IDS_ENV].split(",")]
+    shard_count = int(os.environ[SHARD_COUNT_ENV])
+    logging.info("Worker owns shards %s of %s", shard_ids, shard_count)
+
+is_cluster_parent: bool = sharding_mode == "cluster" and shard_ids is None
+# Cluster workers reach the variable store of the parent at host:port:authkey
+VARIABLES_ENV = "DISCORD_YAML_VARIABLES"
+
+
+def owns_guild(guild_id: int) -> bool:
+    if shard_ids is None: return True
+    return (guild_id >> 22) % shard_count in shard_ids
+
+# Work that is not tied to a guild only runs on the process owning shard 0
+def is_primary_shard() -> bool:
+    return shard_ids is None or 0 in shard_ids
+
+def shard_suffix() -> str:
+    if shard_ids is None: return ""
+    return f".shards-{shard_ids[0]}-{shard_ids[-1]}"
+
+
+end_phase("validation")
+
+def create_client() -> discord.Client:
+    if sharding_mode == "none": return discord.Client(intents=intents, **client_options)
+    logging.info("Using AutoShardedClient: %s shards", shard_count or "recommended")
+    return discord.AutoShardedClient(intents=intents, shard_count=shard_count, shard_ids=shard_ids, **client_options)
+
+client = create_client()
+end_phase("client")
+
+
+# Guilds are chunked the first time a name based lookup needs their members
+chunk_requests: dict[int, asyncio.Future] = {}
+
+async def ensure_chunked(guild: discord.Guild) -> None:
+    if not lazy_chunking or not intents.members: return
+    if not client_options["member_cache_flags"].joined: return
+    guild = client.get_guild(guild.id)
+    if not guild or guild.chunked: return
+
+    if guild.id not in chunk_requests:
+        logging.info("Chunking guild: %s", guild)
+        chunk_requests[guild.id] = asyncio.ensure_future(guild.chunk())
+    try:
+        await asyncio.shield(chunk_requests[guild.id])
+    except Exception as e:
+        logging.error("Chunking failed: %s", e)
+    finally:
+        chunk_requests.pop(guild.id, None)
 
 
 
@@ -142,23 +403,223 @@ client = discord.Client(intents=intents)
 
 # ---------- Create Variables ---------- #
 
-yaml_variables: list[str] = []
+# Read-only view that expressions use to see the variables of one function
+class VariableView(Mapping):
+    def __init__(self, store, func) -> None:
+        self.store = store
+        self.func = func
 
-if "variables" in yaml:
-    logging.info("Assigning variables")
-    for var in yaml["variables"]:
-        logging.info("Assiging: %s", var)
-        if not isinstance(var, str):
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.store.scopes: raise KeyError(name)
+        return self.store.get(name, self.func)
+
+    def __iter__(self):
+        return iter(self.store.scopes)
+
+    def __len__(self) -> int:
+        return len(self.store.scopes)
+
+
+class VariableStore:
+    SCOPES = ["global", "guild", "user", "channel"]
+
+    defaults: dict[str, Any] = None
+    scopes: dict[str, str] = None
+    values: dict[str, dict[str, dict[str, Any]]] = None
+    save_handler = None
+    save_delay: float = 5
+    dirty: bool = False
+    persistent: bool = False
+    # Parent of a cluster: every change is numbered so workers only pull what is new
+    lock = None
+    version: int = 0
+    changed: dict[tuple, int] = None
+    # Cluster workers: assignments not pushed yet, and the last version pulled
+    remote = None
+    pending: dict[tuple, Any] = None
+    synced: int = 0
+    sync_interval: float = 1
+    sync_task: asyncio.Task = None
+
+    def __init__(self) -> None:
+        logging.info("Initialising the VariableStore")
+        self.defaults = {}
+        self.scopes = {}
+        self.values = {scope: {} for scope in self.SCOPES}
+
+    def __contains__(self, name: Any) -> bool:
+        return isinstance(name, str) and name.replace(" ", "_") in self.scopes
+
+    def declare(self, name: str, value: Any, scope: str = "global") -> None:
+        logging.info("Declaring %s variable: %s", scope, name)
+        logging.info("Value: %s", repr(value))
+        if not isinstance(name, str):
             logging.critical("Variable is not a string")
             raise SyntaxError("Variable names must be string.")
-        if not re.fullmatch(r"[A-z_][A-z0-9_]*", var):
+        name = name.replace(" ", "_")
+        if not re.fullmatch(r"[A-z_][A-z0-9_]*", name):
             logging.critical("Invalid variable name")
-            raise SyntaxError(f"'{var}' is not a valid variable name. It can only contain letters, numbers and underscores. It cannot start with a number.")
-        
-        yaml_variables.append(var)
-        logging.info("Value: %s", repr(yaml["variables"][var]))
-        exec(f'{var} = {repr(yaml["variables"][var])}')
-else: logging.info("YAML does not contain variables")
+            raise SyntaxError(f"'{name}' is not a valid variable name. It can only contain letters, numbers and underscores. It cannot start with a number.")
+        if name in self.scopes:
+            logging.critical("Variable is declared twice")
+            raise SyntaxError(f"'{name}' is declared more than once.")
+        self.defaults[name] = value
+        self.scopes[name] = scope
+
+    def scope_key(self, scope: str, func) -> str:
+        if scope == "global": return "global"
+        if not func: return None
+        entity = getattr(func, scope, None)
+        return str(entity.id) if entity else None
+
+    def get(self, name: str, func = None) -> Any:
+        name = name.replace(" ", "_")
+        scope = self.scopes[name]
+        key = self.scope_key(scope, func)
+        values = self.values[scope].get(key)
+        if values is None or name not in values: return self.defaults[name]
+        return values[name]
+
+    def set(self, name: str, value: Any, func = None) -> bool:
+        name = name.replace(" ", "_")
+        scope = self.scopes[name]
+        key = self.scope_key(scope, func)
+        logging.debug("Setting %s variable '%s' for '%s': %s", scope, name, key, repr(value))
+        if key is None:
+            logging.error("Cannot set %s variable '%s' without a %s", scope, name, scope)
+            return False
+        # A value that can not be written to the save file would break every later save
+        if self.persistent:
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError) as e:
+                logging.error("Cannot save %s variable '%s', %s is not JSON: %s", scope, name, type(value).__name__, e)
+                return False
+        self.values[scope].setdefault(key, {})[name] = value
+        if self.pending is not None: self.pending[(scope, key, name)] = value
+        else: self.schedule_save()
+        return True
+
+    # The parent of a cluster keeps the variables of all workers. Workers read a local copy,
+    # push their assignments and pull the ones of other workers every sync interval.
+    # Once the loop runs, every call to the parent is made in an executor so the loop never waits on it.
+
+    # Called by the workers through the parent's variable server, which answers from threads
+    def assign(self, changes: list[tuple]) -> None:
+        with self.lock:
+            for scope, key, name, value in changes:
+                self.values[scope].setdefault(key, {})[name] = value
+                self.version += 1
+                self.changed[(scope, key, name)] = self.version
+            self.dirty = True
+
+    def changes(self, since: int) -> tuple[int, list[tuple]]:
+        with self.lock:
+            return self.version, [(scope, key, name, self.values[scope][key][name]) for (scope, key, name), version in self.changed.items() if version > since]
+
+    # The parent saves the variables in run_cluster
+    def serve(self) -> None:
+        import threading
+        from multiprocessing.managers import BaseManager
+        self.lock = threading.Lock()
+        self.version = 1
+        self.changed = {(scope, key, name): 1 for scope, keys in self.values.items() for key, values in keys.items() for name in values}
+        authkey = os.urandom(16)
+        BaseManager.register("variables", callable=lambda: self, exposed=["assign", "changes"])
+        server = BaseManager(address=("127.0.0.1", 0), authkey=authkey).get_server()
+        threading.Thread(target=server.serve_forever, name="variables", daemon=True).start()
+        host, port = server.address
+        os.environ[VARIABLES_ENV] = f"{host}:{port}:{authkey.hex()}"
+        logging.info("Serving variables on %s:%s", host, port)
+
+    # Blocking, only called before the loop runs or from an executor
+    def connect(self) -> None:
+        from multiprocessing.managers import BaseManager
+        host, port, authkey = os.environ[VARIABLES_ENV].split(":")
+        logging.info("Connecting to the variables of the cluster: %s:%s", host, port)
+        BaseManager.register("variables")
+        manager = BaseManager(address=(host, int(port)), authkey=bytes.fromhex(authkey))
+        manager.connect()
+        self.remote = manager.variables()
+
+    def pull(self) -> tuple[int, list[tuple]]:
+        return self.remote.changes(self.synced)
+
+    # Values assigned here since the last push are newer than what the parent sent
+    def apply(self, version: int, changes: list[tuple]) -> None:
+        for scope, key, name, value in changes:
+            if (scope, key, name) in self.pending or name not in self.scopes: continue
+            self.values[scope].setdefault(key, {})[name] = value
+        self.synced = version
+
+    def share(self) -> None:
+        self.pending = {}
+        try:
+            self.connect()
+            self.apply(*self.pull())
+        except Exception as e:
+            logging.error("Could not load the variables of the cluster: %s", e)
+
+    def start_sync(self) -> None:
+        if self.pending is None or self.sync_task: return
+        self.sync_task = asyncio.ensure_future(self.sync())
+
+    async def sync(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            batch, self.pending = self.pending, {}
+            try:
+                if not self.remote: await loop.run_in_executor(None, self.connect)
+                if batch: await loop.run_in_executor(None, self.remote.assign, [(*key, value) for key, value in batch.items()])
+                self.apply(*await loop.run_in_executor(None, self.pull))
+            except Exception as e:
+                logging.error("Could not sync variables with the cluster: %s", e)
+                for key, value in batch.items(): self.pending.setdefault(key, value)
+
+    def view(self, func = None) -> VariableView:
+        return VariableView(self, func)
+
+    # Variables are kept in the save data and written with the next save
+    def attach(self, save_handler) -> None:
+        logging.info("Saving variables to: %s", save_handler.path)
+        self.save_handler = save_handler
+        saved = save_handler.data.get("variables", {})
+        for scope in self.SCOPES:
+            for key, values in saved.get(scope, {}).items():
+                self.values[scope][key] = {name: value for name, value in values.items() if name in self.scopes}
+        save_handler.data["variables"] = self.values
+
+    # Writes are batched so that a burst of assignments causes a single save
+    def schedule_save(self) -> None:
+        if not self.save_handler or self.dirty: return
+        self.dirty = True
+        try:
+            asyncio.get_running_loop().call_later(self.save_delay, self.flush)
+        except RuntimeError:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.dirty or not self.save_handler: return
+        logging.debug("Flushing variables")
+        self.dirty = False
+        self.save_handler.save()
+
+
+variables = VariableStore()
+
+for scope in VariableStore.SCOPES:
+    section = "variables" if scope == "global" else f"{scope} variables"
+    declared = yaml_get(yaml, section)
+    if not declared:
+        logging.info("YAML does not contain %s", section)
+        continue
+    if not isinstance(declared, dict):
+        logging.critical("%s is of type '%s' and not 'dict'", section, type(declared))
+        raise TypeError(f"'{section}' must be a dictionary.")
+    logging.info("Assigning %s", section)
+    for var in declared:
+        variables.declare(var, declared[var], scope)
 
 
 
@@ -171,22 +632,101 @@ class Guild(discord.Guild):
     def __init__(self, guild: discord.Guild) -> None:
         logging.debug("Converting discord.Guild to Guild: %s", guild)
         if not guild: return
-        self.role_count = len(guild.roles)
-        self.category_count = len(guild.categories)
-        self.forum_count = len(guild.forums)
-        self.channel_count = len(guild.channels)
-        self.emoji_count = len(guild.emojis)
-        self.event_count = len(guild.scheduled_events)
-        self.stage_channel_count = len(guild.stage_channels)
-        self.stage_instance_count = len(guild.stage_instances)
-        self.sticker_count = len(guild.stickers)
-        self.text_channel_count = len(guild.text_channels)
-        self.thread_count = len(guild.threads)
-        self.voice_channel_count = len(guild.voice_channels)
-
         for key in guild.__slots__:
             setattr(self, key, getattr(guild, key))
 
+    # Counts are only computed when read, so wrapping a guild just copies its slots
+
+    @property
+    def role_count(self) -> int: return len(self.roles)
+
+    @property
+    def category_count(self) -> int: return len(self.categories)
+
+    @property
+    def forum_count(self) -> int: return len(self.forums)
+
+    @property
+    def channel_count(self) -> int: return len(self.channels)
+
+    @property
+    def emoji_count(self) -> int: return len(self.emojis)
+
+    @property
+    def event_count(self) -> int: return len(self.scheduled_events)
+
+    @property
+    def stage_channel_count(self) -> int: return len(self.stage_channels)
+
+    @property
+    def stage_instance_count(self) -> int: return len(self.stage_instances)
+
+    @property
+    def sticker_count(self) -> int: return len(self.stickers)
+
+    @property
+    def text_channel_count(self) -> int: return len(self.text_channels)
+
+    @property
+    def thread_count(self) -> int: return len(self.threads)
+
+    @property
+    def voice_channel_count(self) -> int: return len(self.voice_channels)
+
+
+
+
+
+
+# ---------- Metrics ---------- #
+
+class Metrics:
+    path = ""
+    counters: dict[str, int] = None
+    gauges: dict[str, float] = None
+    samples: dict[str, deque] = None
+    sample_size = 1024
+
+    def __init__(self, path: str, sample_size: int = 1024) -> None:
+        logging.info("Initialising metrics: %s", path)
+        self.path = path
+        self.counters = {}
+        self.gauges = {}
+        self.samples = {}
+        self.sample_size = sample_size
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    # Only the latest samples are kept so percentiles follow recent behaviour
+    def observe(self, name: str, value: float) -> None:
+        if name not in self.samples: self.samples[name] = deque(maxlen=self.sample_size)
+        self.samples[name].append(value)
+
+    def percentiles(self, name: str, points: list[int] = [50, 90, 99]) -> dict[str, float]:
+        values = sorted(self.samples.get(name, []))
+        if not values: return {}
+        return {f"p{point}": values[min(len(values) - 1, len(values) * point // 100)] for point in points}
+
+    def snapshot(self) -> dict:
+        return {
+            "time": utcnow().isoformat(),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "percentiles": {name: self.percentiles(name) for name in self.samples}
+        }
+
+    def save(self) -> None:
+        logging.debug("Saving metrics: %s", self.path)
+        with open(self.path, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+
+
+metrics = Metrics(f"metrics{shard_suffix()}.json")
+
 
 
 
@@ -196,14 +736,16 @@ class Guild(discord.Guild):
 
 class SaveHandler:
     path = ""
-    data = {
-        "messages": {},
-        "timers": []
-    }
+    save_pending = False
+    data: dict = None
 
     def __init__(self, path: str) -> None:
         logging.info("Initialising the SaveHandler")
         self.path = path
+        self.data = {
+            "messages": {},
+            "timers": []
+        }
         logging.info("Trying to load: %s", path)
         try:
             with open(path) as f:
@@ -215,8 +757,16 @@ class SaveHandler:
     def save(self) -> None:
         logging.info("Saving: %s", self.path)
         logging.debug("Data: %s", self.data)
-        with open(self.path, "w") as f:
-            json.dump(self.data, f, indent=4)
+        # Written next to the file and moved over it, so a failed save leaves the old file intact
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(self.data, f, indent=4)
+        except Exception as e:
+            logging.error("Saving failed: %s", e)
+            os.remove(temporary)
+            raise
+        os.replace(temporary, self.path)
         logging.debug("Saved")
     
     # I cant specify that func should be a Function because pyton has no forward declaration :(
@@ -267,10 +817,14 @@ class SaveHandler:
         if "messages" not in self.data:
             logging.debug("Created a dictionary for messages in data")
             self.data["messages"] = {}
-        self.data["messages"][func.execution_path] = {
+        msg = {
             "channel": func.msg.channel.id,
             "id": func.msg.id
         }
+        if self.data["messages"].get(func.execution_path) == msg:
+            logging.debug("Message is already saved")
+            return
+        self.data["messages"][func.execution_path] = msg
         self.save()
 
     def save_timer(self, func) -> None:
@@ -302,25 +856,50 @@ class SaveHandler:
 
         self.save()
     
-    def remove_timer_by_path(self, execution_path: str) -> None:
-        logging.log("Removing timer: %s", execution_path)
-        found = False
-        for x in self.get_timers():
-            if x["func"] == execution_path:
-                found = True
-                self.data["timers"].remove(x)
-                logging.info("Removed timer")
-                break
-        if found: self.save()
-        else: logging.warn("Could not find timer")
-
-    def remove_timers(self, timers: list[dict]) -> None:
-        logging.log("Removing timers: %s", [x.get("func") for x in timers])
-        for x in timers:
-            self.data["timers"].remove(x)
+    # Removes the timer itself rather than an equal one, the file is written once for every
+    # timer removed in the same iteration of the event loop
+    def remove_timer(self, timer: dict) -> None:
+        logging.info("Removing timer: %s", timer.get("func"))
+        timers = self.get_timers()
+        for index, x in enumerate(timers):
+            if x is not timer: continue
+            del timers[index]
+            self.schedule_save()
+            return
+        logging.warn("Could not find timer")
+
+    def schedule_save(self) -> None:
+        if self.save_pending: return
+        self.save_pending = True
+        asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.save_pending = False
         self.save()
 
 
+    # Progress of bulk role updates so an interrupted run can resume
+    def save_bulk(self, execution_path: str, raw_function: dict, channel, user, guild, done: set[int]) -> None:
+        logging.info("Saving bulk progress: %s", execution_path)
+        if "bulk" not in self.data:
+            logging.debug("Created a dictionary for bulk progress in data")
+            self.data["bulk"] = {}
+        self.data["bulk"][execution_path] = {
+            "function": raw_function,
+            "channel": channel.id if channel else None,
+            "user": user.id if user else None,
+            "guild": guild.id if guild else None,
+            "done": list(done)
+        }
+        self.save()
+
+    def get_bulk(self, execution_path: str) -> dict:
+        return self.data.get("bulk", {}).get(execution_path)
+
+    def remove_bulk(self, execution_path: str) -> None:
+        logging.info("Removing bulk progress: %s", execution_path)
+        if self.data.get("bulk", {}).pop(execution_path, None) is not None: self.save()
+
     def get_timers(self) -> list[dict]:
         value = self.data.get("timers", [])
         logging.debug("Retreiving timers: %s", value)
@@ -334,14 +913,206 @@ class SaveHandler:
 
 
 
-save_data = SaveHandler("data.json")
+save_data = SaveHandler(f"data{shard_suffix()}.json")
+# Cluster workers use the variables of the parent, which saves them in its own data file
+variables.persistent = bool(yaml_get(yaml, "save variables", False))
+if variables.persistent and shard_ids is None: variables.attach(save_data)
+if shard_ids is not None and os.getenv(VARIABLES_ENV):
+    variables.sync_interval = to_seconds(yaml_get(sharding, "variable sync", 1)) or 1
+    variables.share()
 
 
 
 
 
 
+# ---------- Resolver Cache ---------- #
 
+# Remembers REST lookups, including the ones that came back NotFound or Forbidden
+class ResolverCache:
+    ttls: dict[str, float] = None
+    missing_ttl: float = 60
+    max_entries: int = 10000
+    entries: dict[tuple, tuple[float, Any]] = None
+    pending: dict[tuple, asyncio.Task] = None
+
+    def __init__(self, ttls: dict[str, float], missing_ttl: float = 60, max_entries: int = 10000) -> None:
+        logging.info("Initialising the ResolverCache: %s", ttls)
+        self.ttls = ttls
+        self.missing_ttl = missing_ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.pending = {}
+
+    def count(self, kind: str, result: str) -> None:
+        metrics.increment(f"resolver.{kind}.{result}")
+        hits = metrics.counters.get(f"resolver.{kind}.hit", 0)
+        lookups = hits + metrics.counters.get(f"resolver.{kind}.miss", 0)
+        metrics.set(f"resolver.{kind}.hit_rate", hits / lookups if lookups else 0)
+
+    async def fetch(self, kind: str, key: Any, fetcher) -> Any:
+        entry = self.entries.get((kind, key))
+        if entry and entry[0] > time.monotonic():
+            logging.debug("Resolver cache hit: %s %s", kind, key)
+            self.count(kind, "hit")
+            return entry[1]
+
+        # Concurrent lookups of the same ID share one request
+        task = self.pending.get((kind, key))
+        if task: self.count(kind, "deduplicated")
+        else:
+            self.count(kind, "miss")
+            task = self.pending[(kind, key)] = asyncio.ensure_future(self.request(kind, key, fetcher))
+        return await asyncio.shield(task)
+
+    async def request(self, kind: str, key: Any, fetcher) -> Any:
+        try:
+            value = await fetcher()
+            self.store(kind, key, value, self.ttls.get(kind, 0))
+            return value
+        except (discord.NotFound, discord.Forbidden) as e:
+            logging.warn("Could not fetch %s %s: %s", kind, key, e)
+            self.count(kind, "missing")
+            self.store(kind, key, None, self.missing_ttl)
+            return None
+        finally:
+            self.pending.pop((kind, key), None)
+
+    def store(self, kind: str, key: Any, value: Any, ttl: float) -> None:
+        if not ttl: return
+        self.entries.pop((kind, key), None)
+        self.entries[(kind, key)] = (time.monotonic() + ttl, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+
+
+resolver_settings: dict = yaml.get("resolver cache") or yaml.get("resolver_cache") or {}
+resolver_cache = ResolverCache(
+    {
+        kind: to_seconds(resolver_settings.get(kind, default))
+        for kind, default in [("members", "1m"), ("users", "5m"), ("channels", "10m"), ("guilds", "10m")]
+    },
+    to_seconds(resolver_settings.get("missing", "1m")),
+    int(yaml_get(resolver_settings, "max entries", 10000))
+)
+
+
+
+
+
+
+
+
+
+
+
+
+
+# ---------- Attachments ---------- #
+
+# Reads a cached buffer without copying it, discord.File needs a seekable file object
+class BufferReader(io.RawIOBase):
+    def __init__(self, buffer, name: str) -> None:
+        self.buffer = memoryview(buffer)
+        self.position = 0
+        self.name = name
+
+    def readable(self) -> bool: return True
+    def seekable(self) -> bool: return True
+    def tell(self) -> int: return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET: self.position = offset
+            case io.SEEK_CUR: self.position += offset
+            case io.SEEK_END: self.position = len(self.buffer) + offset
+        return self.position
+
+    def readinto(self, target) -> int:
+        size = max(0, min(len(target), len(self.buffer) - self.position))
+        target[:size] = self.buffer[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+# Anything that is not an existing file is passed to Discord unchanged, like before local files were supported
+def is_local_file(value: Any) -> bool:
+    return isinstance(value, str) and not value.startswith(("http://", "https://", "attachment://")) and os.path.isfile(value)
+
+# Files are read once and kept until the cache is full, large files are memory mapped.
+# The CDN URL of an uploaded file is remembered until it expires so embeds can
+# reference it instead of uploading the file again.
+class AttachmentCache:
+    def __init__(self, max_size: int, mmap_size: int) -> None:
+        self.max_size = max_size
+        self.mmap_size = mmap_size
+        self.size = 0
+        self.buffers: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self.urls: dict[tuple[str, float], tuple[str, float]] = {}
+
+    def read(self, path: str):
+        stat = os.stat(path)
+        cached = self.buffers.get(path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            self.buffers.move_to_end(path)
+            metrics.increment("attachments.hit")
+            return cached[2]
+
+        metrics.increment("attachments.miss")
+        logging.info("Reading attachment: %s", path)
+        with open(path, "rb") as f:
+            if stat.st_size >= self.mmap_size:
+                import mmap
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else: buffer = f.read()
+
+        if cached: self.size -= cached[1]
+        self.buffers[path] = (stat.st_mtime, stat.st_size, buffer)
+        self.size += stat.st_size
+        # Buffers still used by an upload stay alive until the upload is done
+        while self.size > self.max_size and len(self.buffers) > 1:
+            _, (_, size, _) = self.buffers.popitem(last=False)
+            self.size -= size
+        return buffer
+
+    def file(self, path: str, filename: str = None, spoiler: bool = False, description: str = None) -> discord.File:
+        filename = filename or os.path.basename(path)
+        return discord.File(BufferReader(self.read(path), filename), filename, spoiler=spoiler, description=description)
+
+    def url(self, path: str) -> str:
+        try:
+            key = (path, os.stat(path).st_mtime)
+        except OSError:
+            return None
+        url, expires = self.urls.get(key, (None, 0))
+        if not url: return None
+        if expires and expires - 60 < time.time():
+            self.urls.pop(key, None)
+            return None
+        metrics.increment("attachments.reused")
+        return url
+
+    # Attachment URLs are signed, 'ex' is when the signature expires in hex
+    def remember(self, msg: discord.Message, paths: dict[str, str]) -> None:
+        if not msg or not paths: return
+        urls = [attachment.url for attachment in msg.attachments]
+        for embed in msg.embeds: urls += [embed.image.url, embed.thumbnail.url]
+        for url in urls:
+            if not url: continue
+            filename = url.split("?")[0].rsplit("/", 1)[-1]
+            if filename not in paths: continue
+            expires = re.search(r"[?&]ex=([0-9a-f]+)", url)
+            try:
+                self.urls[(paths[filename], os.stat(paths[filename]).st_mtime)] = (url, int(expires.group(1), 16) if expires else 0)
+            except OSError: pass
+
+
+# Sizes are in MiB
+attachment_settings: dict = yaml.get("attachments") or {}
+attachments = AttachmentCache(
+    int(float(yaml_get(attachment_settings, "cache size", 32)) * 1024 * 1024),
+    int(float(yaml_get(attachment_settings, "memory map size", 1)) * 1024 * 1024)
+)
 
 
 
@@ -351,22 +1122,86 @@ save_data = SaveHandler("data.json")
 # ---------- Functions ---------- #
 # Functions should probably have their own file but Im too lazy
 
+# Keys next to the function name that change how it is run rather than what it does
+FUNCTION_MODIFIERS = ["timeout", "on timeout", "on_timeout"]
+
+# The same expressions are evaluated on every event, so they are only compiled once
+@lru_cache(maxsize=1024)
+def compile_expression(source: str, flags: int = 0):
+    return compile(source, "<yaml>", "eval", flags=flags)
+
+
+# Every name a compiled expression can look up, including the ones in its comprehensions and lambdas
+@lru_cache(maxsize=1024)
+def code_names(code) -> tuple[str, ...]:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const): names.update(code_names(const))
+    return tuple(names)
+
+
+# Builtins that give the same result for the same arguments
+PURE_BUILTINS = frozenset(name for name in dir(builtins) if not name.startswith("_")) - {
+    "open", "input", "print", "eval", "exec", "compile", "globals", "locals", "vars",
+    "id", "hash", "iter", "next", "breakpoint", "help", "exit", "quit", "setattr", "delattr"
+}
+
+# Names an expression (or an f-string template) reads, None when it can not be parsed
+@lru_cache(maxsize=1024)
+def source_names(source: Any, template: bool = True) -> frozenset:
+    if not isinstance(source, str): return frozenset()
+    try:
+        tree = ast.parse(f"f{repr(source)}" if template else source, mode="eval")
+    except SyntaxError:
+        return None
+    return frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+# A value to compare later renders against, containers are compared by their repr so
+# changes made to them in place are noticed. The type is part of it as 1, 1.0 and True are equal
+def freeze(value: Any) -> tuple:
+    if isinstance(value, PLAIN_TYPES): return (type(value), value)
+    return (type(value), repr(value))
+
+
+# Shared by every function of one run_code invocation so the guild wrapper and
+# extra data are built once per event instead of once per function
+class ExecutionContext:
+    __slots__ = ("channel", "user", "guild", "extra_data", "counts")
+
+    def __init__(self, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, extra_data: dict = None) -> None:
+        self.channel = channel
+        self.user = user
+        if not guild and isinstance(user, discord.Member):
+            guild = user.guild
+            logging.debug("Assigned guild through user: %s", guild)
+        self.guild = guild if guild is None or isinstance(guild, Guild) else Guild(guild)
+        self.extra_data = {} if extra_data is None else extra_data
+        self.counts: dict[str, int] = {}
+
+    # Numbers repeated function names so every function has a unique execution path
+    def number(self, func: "Function") -> None:
+        count = self.counts.get(func.function_name, 0) + 1
+        self.counts[func.function_name] = count
+        if count > 1: func.execution_path += " " + str(count)
+
+
 # Abstract-ish (you can instantiate it but it will convert itself to the correct type)
 class Function:
     channel: discord.TextChannel = None
     user: discord.Member | discord.User = None
     guild: discord.Guild = None
-    raw_function = {}
+    raw_function = None
     function_name = ""
     execution_path = ""
-    additional_variables = {}
+    additional_variables = None
 
-    def __init__(self, raw_function: dict = None, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, execution_path: str = "") -> None:
+    def __init__(self, raw_function: dict = None, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, execution_path: str = "", context: ExecutionContext = None) -> None:
         logging.info("Initialising function: %s", execution_path)
         logging.debug("Raw function: %s", raw_function)
         logging.debug("Channel: %s", channel)
         logging.debug("User: %s", user)
         logging.debug("Guild: %s", guild)
+        
         self.channel = None
         self.user = None
         self.guild = None
@@ -374,21 +1209,23 @@ class Function:
         self.function_name = ""
         self.execution_path = ""
         self.additional_variables = {}
-        
+
         if not raw_function:
             logging.error("Invalid Function")
             return
         if not isinstance(raw_function, dict):
             logging.error("Function is of type '%s' and 'dict'", type(raw_function))
             return
-        self.channel = channel
-        self.user = user
-        if guild: self.guild = Guild(guild)
-        elif isinstance(user, discord.Member):
-            self.guild = Guild(user.guild)
-            logging.debug("Assigned guild through user: %s", user.guild)
+        if context is None: context = ExecutionContext(channel, user, guild)
+        self.channel = context.channel
+        self.user = context.user
+        self.guild = context.guild
+        self.additional_variables = context.extra_data
         self.raw_function = raw_function
-        self.function_name = list(raw_function.keys())[0]
+        for key in raw_function:
+            if key in FUNCTION_MODIFIERS: continue
+            self.function_name = key
+            break
         self.execution_path = execution_path + " -> " + self.function_name
         self.assign_type(self.function_name)
 
@@ -399,6 +1236,7 @@ class Function:
             case "remove_role" | "remove_roles": self.__class__ = FunctionRemoveRoles
             case "set_variable" | "set_variables": self.__class__ = FunctionSetVariable
             case "update_roles": self.__class__ = FunctionUpdateRoles
+            case "bulk_update_roles": self.__class__ = FunctionBulkUpdateRoles
             case "update_message": self.__class__ = FunctionUpdateMessage
             case "send_message": self.__class__ = FunctionSendMessage
             case "response": self.__class__ = FunctionResponseMessage
@@ -428,16 +1266,16 @@ class Function:
 
         if isinstance(id, str):
             var = id.replace(" ", "_")
-            if var in yaml_variables:
+            if var in variables:
                 logging.debug("Resolving variable")
-                return await self.get_user(eval(var))
+                return await self.get_user(self.variable(var))
             if id.startswith("@"): id = id[1:]
 
         if self.guild:
             logging.debug("Checking guild members")
             if isinstance(id, int):
                 user = self.guild.get_member(id)
-                if not user: user = await self.guild.fetch_member(id)
+                if not user: user = await resolver_cache.fetch("members", (self.guild.id, id), lambda: self.guild.fetch_member(id))
                 return user
             
             elif not isinstance(id, str):
@@ -448,12 +1286,13 @@ class Function:
                 logging.debug("Returning self.user")
                 return self.user
 
+            await ensure_chunked(self.guild)
             return self.guild.get_member_named(id)
 
         else:
             if isinstance(id, int):
                 user = client.get_user(id)
-                if not user: user = await client.fetch_user(id)
+                if not user: user = await resolver_cache.fetch("users", id, lambda: client.fetch_user(id))
                 return user
             
             elif not isinstance(id, str):
@@ -464,10 +1303,33 @@ class Function:
                 if str(user) == id: return user
                 if user.name == id: return user
             
-            for user in client.get_all_members():
-                if str(user) == id: return user
-                if user.name == id: return user
-                if user.nick == id: return user
+            # Guilds that are not chunked yet are chunked one by one until the member is found
+            for guild in client.guilds:
+                await ensure_chunked(guild)
+                for user in guild.members:
+                    if str(user) == id: return user
+                    if user.name == id: return user
+                    if user.nick == id: return user
+
+    # A role, a list of roles or an expression that evaluates to either
+    def find_roles(self, value) -> list[discord.Role]:
+        if isinstance(value, str):
+            try:
+                value = int(value)
+            except:
+                role = self.get_role(value)
+                if role: return [role]
+                value = self.evaluate(value)
+
+        if not isinstance(value, list): value = [value]
+        roles = []
+        for role_id in value:
+            try:
+                role_id = int(role_id)
+            except: pass
+            role = self.get_role(role_id)
+            if role: roles.append(role)
+        return roles
 
     def get_role(self, id: int | str) -> discord.Role:
         logging.info("Rerieving role: %s", id)
@@ -477,9 +1339,9 @@ class Function:
 
         if isinstance(id, str):
             var = id.replace(" ", "_")
-            if var in yaml_variables:
+            if var in variables:
                 logging.debug("Resolving variable")
-                return self.get_role(eval(var))
+                return self.get_role(self.variable(var))
             if id.startswith("@"): id = id[1:]
         
         if not self.guild:
@@ -527,7 +1389,7 @@ class Function:
         if isinstance(id, int):
             channel = client.get_channel(id)
             if channel: return channel
-            channel = await client.fetch_channel(id)
+            channel = await resolver_cache.fetch("channels", id, lambda: client.fetch_channel(id))
             return channel
 
         if not isinstance(id, str):
@@ -535,12 +1397,16 @@ class Function:
             return None
 
         var = id.replace(" ", "_")
-        if var in yaml_variables:
+        if var in variables:
             logging.debug("Resolving variable")
-            return await self.get_channel(eval(var))
+            return await self.get_channel(self.variable(var))
 
         if id.startswith("#"): id = id[1:]
 
+        if self.guild:
+            for channel in self.guild.channels:
+                if channel.name == id: return channel
+
         for channel in client.get_all_channels():
             if channel.name == id: return channel
         
@@ -555,9 +1421,9 @@ class Function:
         if isinstance(id, int):
             logging.debug("Colour is int, returning as is")
             return id
-        if id in yaml_variables:
+        if id in variables:
             logging.debug("Resolving variable")
-            return self.get_colour(eval(id))
+            return self.get_colour(self.variable(id))
         
         logging.warn("Could not find colour")
         return None
@@ -570,7 +1436,7 @@ class Function:
         emoji = None
 
         if isinstance(id, str):
-            if emojilib.is_emoji(id):
+            if is_emoji(id):
                 logging.debug("Emoji is native, returning as is")
                 return id
             name = re.match(r":(.+):", id)
@@ -601,7 +1467,7 @@ class Function:
         if isinstance(id, int):
             server = client.get_guild(id)
             if server: return Guild(server)
-            server = await client.fetch_guild(id)
+            server = await resolver_cache.fetch("guilds", id, lambda: client.fetch_guild(id))
             if server: return Guild(server)
             logging.warn("Could not find server")
             return None
@@ -610,9 +1476,9 @@ class Function:
             logging.warn("Server is not int or string")
             return None
         
-        if id in yaml_variables:
+        if id in variables:
             logging.debug("Resolving variable")
-            return await self.get_server(eval(id))
+            return await self.get_server(self.variable(id))
 
         for server in client.guilds:
             if server.name == id: return Guild(server)
@@ -620,24 +1486,56 @@ class Function:
         logging.warn("Could not find server")
         return None
 
+    def variable(self, name: str) -> Any:
+        return variables.get(name, self)
+
+    # The values a render reads, None when it reads anything but variables and pure builtins.
+    # Sources are (string, is a template) pairs.
+    def dependency_key(self, sources: list[tuple[Any, bool]]) -> tuple:
+        if sources is None: return None
+        key = []
+        for source, template in sources:
+            names = source_names(source, template)
+            if names is None: return None
+            for name in names:
+                if name in self.__dict__ or name in self.additional_variables: return None
+                if name in variables: key.append((name, freeze(self.variable(name))))
+                elif name not in PURE_BUILTINS: return None
+        return tuple(key)
+
+    def variable_mapping(self) -> Mapping:
+        return variables.view(self)
+
+    # Names an expression can read: its arguments, the function, extra data and the variables.
+    # Options of app commands come before the function so an option named user is not the user
+    def namespace(self, kwargs: dict = None) -> ChainMap:
+        if kwargs is None: kwargs = {}
+        options = self.additional_variables.get("options")
+        if isinstance(options, dict): return ChainMap(kwargs, options, self.__dict__, self.additional_variables, self.variable_mapping())
+        return ChainMap(kwargs, self.__dict__, self.additional_variables, self.variable_mapping())
+
+    # Comprehensions and lambdas only see the globals of an expression, not its locals, so the
+    # names it reads are looked up in the namespace and passed as its globals
+    def scope(self, code, kwargs: dict = None) -> dict:
+        namespace = self.namespace(kwargs)
+        module = globals()
+        result = {"__builtins__": builtins}
+        for name in code_names(code):
+            try:
+                result[name] = namespace[name]
+            except KeyError:
+                if name in module: result[name] = module[name]
+        return result
+
     def evaluate(self, _string: str, **kwargs) -> Any:
         logging.info("Evaluating: %s", _string)
         if not _string:
             logging.warn("Nothing to evaluate")
             return _string
 
-        for _key in self.additional_variables:
-            exec(f"{_key} = self.additional_variables[{repr(_key)}]")
-
-        for _key in self.__dict__:
-            if _key == "additional_variables": continue
-            exec(f"{_key} = self.{_key}")
-        
-        for _key in kwargs:
-            exec(f"{_key} = {repr(kwargs[_key])}")
-
         try:
-            result = eval(_string)
+            code = compile_expression(_string)
+            result = eval(code, self.scope(code, kwargs))
             logging.info("Evaluated: %s", result)
             return result
         except Exception as e:
@@ -650,18 +1548,28 @@ class Function:
             logging.warn("Nothing to evaluate")
             return _string
 
-        for _dictionary in [self.__dict__, self.additional_variables]:
-            for _key in _dictionary:
-                exec(f"{_key} = self.{_key}")
-        
         try:
-            result = eval(f"f{repr(_string)}")
+            code = compile_expression(f"f{repr(_string)}")
+            result = eval(code, self.scope(code))
             logging.info("Evaluated: %s", result)
             return result
         except Exception as e:
             logging.error(e)
             return ""
 
+    # Like evaluate, but the expression may use await
+    async def aevaluate(self, _string: str, default: Any = None) -> Any:
+        logging.info("Async evaluation: %s", _string)
+        try:
+            code = compile_expression(_string, ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+            result = eval(code, self.scope(code))
+            if code.co_flags & inspect.CO_COROUTINE: result = await result
+            logging.info("Evaluated: %s", result)
+            return result
+        except Exception as e:
+            logging.error(e)
+            return default
+
     def evaluate_condition(self, condition: dict) -> dict:
         logging.info("Evaluating condition: %s", condition.get("if"))
         if self.evaluate(condition.get("if")):
@@ -672,30 +1580,32 @@ class Function:
         logging.debug("Data: %s", condition.get("else"))
         return condition.get("else", {"?":{}})
 
-    async def aexec(self, code: str) -> None:
-        logging.info("Async execution: %s", code)
-        try:
-            # Make an async function with the code and `exec` it
-            exec(
-                'async def __exec(self):\n' +
-                ''.join(f'\n {l}' for l in code.split('\n'))
-            )
-            await locals()["__exec"](self)
-        except Exception as e:
-            logging.error(e)
-
-
+    # Objects are re-bound from the gateway caches, REST is only used when the
+    # cache is complete and the object is not in it
     async def refresh(self) -> None:
         logging.info("Refresing function: %s", self.execution_path)
         if self.guild:
             logging.debug("Refresing guild: %s", self.guild)
-            self.guild = await self.get_server(self.guild.id)
+            guild = client.get_guild(self.guild.id)
+            if guild: self.guild = Guild(guild)
+            else: self.guild = await self.get_server(self.guild.id)
         if self.channel:
             logging.debug("Refresing channel: %s", self.channel)
-            self.channel = await self.get_channel(self.channel.id)
+            channel = client.get_channel(self.channel.id)
+            if channel: self.channel = channel
+            elif not isinstance(self.channel, discord.abc.PrivateChannel): self.channel = await self.get_channel(self.channel.id)
         if self.user:
             logging.debug("Refresing user: %s", self.user)
-            self.user = await self.get_user(self.user.id)
+            if self.guild:
+                user = self.guild.get_member(self.user.id)
+                if user: self.user = user
+                elif self.guild.chunked:
+                    try:
+                        self.user = await self.get_user(self.user.id)
+                    except discord.HTTPException as e:
+                        logging.warn("Could not refresh user: %s", e)
+            else:
+                self.user = client.get_user(self.user.id) or self.user
 
 
 class FunctionCondition(Function):
@@ -709,11 +1619,13 @@ class FunctionCondition(Function):
 # Abstract
 class FunctionRoles(Function):
     target: discord.Member = None
-    roles: list[discord.Role] = []
+    targets: list[discord.Member] = None
+    roles: list[discord.Role] = None
     reason: str = None
 
     async def find_arguments(self, arguments) -> None:
         self.target = None
+        self.targets = []
         self.roles = []
         self.reason = None
 
@@ -723,9 +1635,14 @@ class FunctionRoles(Function):
             arguments = {"roles": arguments}
         
         self.target = await self.get_user(arguments.get("target", None))
-        if not self.target:
-            if not isinstance(self.user, discord.Member): return
-            self.target = self.user
+        if not self.target and isinstance(self.user, discord.Member): self.target = self.user
+        # Batched events apply the roles to every user in the batch
+        if self.target: self.targets = [self.target]
+        else:
+            users = self.additional_variables.get("users", [])
+            if not isinstance(users, list): raise TypeError(f"Users must be a list, not '{type(users).__name__}'.\nTrace: {self.execution_path}")
+            self.targets = [user for user in users if isinstance(user, discord.Member)]
+        if not self.targets: return
 
         for key in ["role", "roles"]:
             if key not in arguments: continue
@@ -758,26 +1675,31 @@ class FunctionRoles(Function):
 
     async def execute(self) -> bool:
         await super().execute()
-        if not self.target: return False
+        if not self.targets: return False
         if not self.roles: return False
         return True
 
+# Members that already have (or lack) every role are skipped, which saves a request per member in a batch
 class FunctionAddRoles(FunctionRoles):
     async def execute(self) -> bool:
         if not await super().execute(): return False
-        await self.target.add_roles(*self.roles, reason=self.reason)
+        for target in self.targets:
+            roles = [role for role in self.roles if role not in target.roles]
+            if roles: await target.add_roles(*roles, reason=self.reason)
         return True
 
 class FunctionRemoveRoles(FunctionRoles):
     async def execute(self) -> bool:
         if not await super().execute(): return False
-        await self.target.remove_roles(*self.roles, reason=self.reason)
+        for target in self.targets:
+            roles = [role for role in self.roles if role in target.roles]
+            if roles: await target.remove_roles(*roles, reason=self.reason)
         return True
 
 class FunctionUpdateRoles(Function):
     target: discord.Member = None
-    add: list[discord.Role] = []
-    remove: list[discord.Role] = []
+    add: list[discord.Role] = None
+    remove: list[discord.Role] = None
     reason: str = None
 
     async def find_arguments(self, arguments) -> None:
@@ -798,28 +1720,7 @@ class FunctionUpdateRoles(Function):
 
         for key in ["add", "remove"]:
             if key not in arguments: continue
-            value = arguments[key]
-            
-            if isinstance(value, str):
-                try:
-                    value = int(value)
-                except:
-                    role = self.get_role(value)
-                    if role:
-                        exec(f"self.{key}.append(role)")
-                        continue
-                    value = self.evaluate(value)
-
-            if isinstance(value, list):
-                for role_id in value:
-                    try:
-                        role_id = int(role_id)
-                    except: pass
-                    role = self.get_role(role_id)
-                    if role: exec(f"self.{key}.append(role)")
-            else:
-                role = self.get_role(value)
-                if role: exec(f"self.{key}.append(role)")
+            getattr(self, key).extend(self.find_roles(arguments[key]))
         
         self.reason = arguments.get("reason", None)
 
@@ -837,10 +1738,121 @@ class FunctionUpdateRoles(Function):
             await self.target.add_roles(*add_roles, reason=self.reason)
         return True
 
+# Execution paths of bulk role updates in progress
+bulk_running: set[str] = set()
+
+class FunctionBulkUpdateRoles(Function):
+    selector: dict = None
+    add: list[discord.Role] = None
+    remove: list[discord.Role] = None
+    reason: str = None
+    workers: int = 2
+
+    async def find_arguments(self, arguments) -> None:
+        self.selector = {}
+        self.add = []
+        self.remove = []
+        self.reason = None
+        self.workers = 2
+
+        await super().find_arguments(arguments)
+        if not isinstance(arguments, dict):
+            raise TypeError(f"'{arguments}' is not a dict.\nTrace: {self.execution_path}")
+
+        self.selector = arguments.get("members") or {}
+        if not isinstance(self.selector, dict):
+            raise TypeError(f"Members must be a dictionary.\nTrace: {self.execution_path} -> members")
+
+        for key in ["add", "remove"]:
+            if key not in arguments: continue
+            getattr(self, key).extend(self.find_roles(arguments[key]))
+
+        self.reason = arguments.get("reason", None)
+        self.workers = max(1, int(arguments.get("workers", 2)))
+
+    # One pass over the member cache
+    def select_members(self) -> list[discord.Member]:
+        members = self.guild.members
+        role = self.selector.get("role")
+        if role is not None:
+            role = self.get_role(role)
+            if not role:
+                logging.warn("Could not find the role to select members by")
+                return []
+            members = role.members
+
+        joined_before = yaml_get(self.selector, "joined before")
+        if joined_before: joined_before = utcnow() - string_to_timedelta(joined_before)
+        condition = self.selector.get("if")
+
+        selected = []
+        for member in members:
+            if joined_before and (not member.joined_at or member.joined_at > joined_before): continue
+            if condition and not self.evaluate(condition, member=member): continue
+            selected.append(member)
+        return selected
+
+    async def execute(self) -> bool:
+        await super().execute()
+        if not self.guild: return False
+        if not self.add and not self.remove: return False
+
+        if self.execution_path in bulk_running:
+            logging.warn("Bulk role update is already running: %s", self.execution_path)
+            return False
+        bulk_running.add(self.execution_path)
+        try:
+            return await self.update_members()
+        finally:
+            bulk_running.discard(self.execution_path)
+
+    async def update_members(self) -> bool:
+        await ensure_chunked(self.guild)
+        checkpoint = save_data.get_bulk(self.execution_path)
+        done: set[int] = set(checkpoint.get("done", [])) if checkpoint else set()
+        if done: logging.info("Resuming bulk role update after %s members", len(done))
+
+        add = set(self.add)
+        remove = set(self.remove) - add
+        queue: asyncio.Queue = asyncio.Queue()
+        for member in self.select_members():
+            if member.id in done: continue
+            # Members already in the desired state cost no requests
+            if add.issubset(member.roles) and remove.isdisjoint(member.roles):
+                metrics.increment("bulk_roles.skipped")
+                continue
+            queue.put_nowait(member)
+
+        logging.info("Updating roles of %s members", queue.qsize())
+        save_data.save_bulk(self.execution_path, self.raw_function, self.channel, self.user, self.guild, done)
+
+        # discord.py waits out rate limits, the workers only keep the number of requests in flight low
+        async def worker() -> None:
+            while not queue.empty():
+                member = queue.get_nowait()
+                try:
+                    remove_roles = remove.intersection(member.roles)
+                    add_roles = add - set(member.roles)
+                    if remove_roles: await member.remove_roles(*remove_roles, reason=self.reason)
+                    if add_roles: await member.add_roles(*add_roles, reason=self.reason)
+                    metrics.increment("bulk_roles.updated")
+                except discord.HTTPException as e:
+                    # Failed members are not marked as done so a resumed run tries them again
+                    logging.error("Could not update roles of '%s': %s", member, e)
+                    metrics.increment("bulk_roles.failed")
+                    continue
+                done.add(member.id)
+                if len(done) % 25 == 0: save_data.save_bulk(self.execution_path, self.raw_function, self.channel, self.user, self.guild, done)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        save_data.remove_bulk(self.execution_path)
+        return True
+
 class FunctionSetVariable(Function):
-    variables: list[str] = []
+    FAILED = object()
+    variables: list[str] = None
     evaluate_values: bool = False
-    arguments: dict = {}
+    arguments: dict = None
 
     async def find_arguments(self, arguments) -> None:
         self.variables = []
@@ -855,7 +1867,7 @@ class FunctionSetVariable(Function):
                 self.evaluate_values = arguments[var]
                 continue
             
-            if var.replace(" ", "_") not in yaml_variables:
+            if var not in variables:
                 raise NameError(f"{var} is not defined.\nTrace: {self.execution_path}")
             
             self.variables.append(var)
@@ -864,10 +1876,16 @@ class FunctionSetVariable(Function):
         await super().execute()
         if not self.variables: return False
 
+        # Everything is evaluated before assigning so a cancelled assignment changes nothing.
+        # A variable whose expression fails keeps its value
+        values = {}
         for var in self.variables:
-            var_name = var.replace(" ", "_")
-            if self.evaluate_values: await self.aexec(f"global {var_name}; {var_name} = {self.arguments[var]}")
-            else: await self.aexec(f"global {var_name}; {var_name} = {repr(self.arguments[var])}")
+            value = self.arguments[var]
+            if self.evaluate_values and isinstance(value, str): value = await self.aevaluate(value, self.FAILED)
+            if value is self.FAILED: continue
+            values[var] = value
+
+        for var, value in values.items(): variables.set(var, value, self)
         
         return True
 
@@ -876,9 +1894,9 @@ class FunctionMessage(Function):
     content = ""
     tts: bool = False
     embed: discord.Embed = None
-    embeds: list[discord.Embed] = []
+    embeds: list[discord.Embed] = None
     file: discord.File = None
-    files: list[discord.File] = []
+    files: list[discord.File] = None
     delete_after: float = None
     allowed_mentions: discord.AllowedMentions = None
     reference = None
@@ -888,6 +1906,9 @@ class FunctionMessage(Function):
     suppress_embeds: bool = False
     silent: bool = False
     has_condition: bool = False
+    attachment_paths: dict[str, str] = None
+    # Rendered content items by trace, kept for re-renders when the message has components
+    render_cache: dict[str, tuple] = None
 
     msg: discord.Message = None
 
@@ -912,11 +1933,26 @@ class FunctionMessage(Function):
         elif self.embeds: args["embeds"] = self.embeds
 
         self.msg = await self.channel.send(self.content, **args)
+        attachments.remember(self.msg, self.attachment_paths)
     
-    def get_edit_args(self) -> dict:
+    # Uploaded files can't be compared by content, the name and size of the local file is enough
+    def attachment_keys(self) -> list[tuple[str, int]]:
+        keys = []
+        for file in [self.file] if self.file else self.files:
+            try: keys.append((file.filename, os.path.getsize(self.attachment_paths[file.filename])))
+            except (KeyError, OSError): return None
+        return sorted(keys)
+
+    def same_attachments(self, msg: discord.Message) -> bool:
+        if not msg: return False
+        return self.attachment_keys() == sorted((x.filename, x.size) for x in msg.attachments)
+
+    # Attachments are left out when the message already has them so they are not uploaded again
+    def get_edit_args(self, msg: discord.Message = None) -> dict:
         args = {}
-        if self.file: args["attachments"] = self.file
-        elif self.files: args["attachments"] = self.files
+        if not self.same_attachments(msg):
+            if self.file: args["attachments"] = [self.file]
+            elif self.files: args["attachments"] = self.files
 
         for key in ["content", "embed", "embeds", "view", "delete_after", "allowed_mentions"]:
             if key == "embeds" and "embed" in args: continue
@@ -927,7 +1963,8 @@ class FunctionMessage(Function):
 
     async def edit(self):
         if not self.msg: return
-        self.msg = await self.msg.edit(**self.get_edit_args())
+        self.msg = await self.msg.edit(**self.get_edit_args(self.msg))
+        attachments.remember(self.msg, self.attachment_paths)
 
     def compare_to(self, msg: discord.Message) -> bool:
         if self.view: return False
@@ -935,8 +1972,7 @@ class FunctionMessage(Function):
         if len(msg.embeds) == 1:
             if msg.embeds[0] != self.embed: return False
         elif msg.embeds != self.embeds: return False
-        if self.file: return [self.file] == msg.attachments
-        return self.files == msg.attachments
+        return self.same_attachments(msg)
         
     async def find_arguments(self, arguments) -> None:
         self.content = ""
@@ -954,6 +1990,7 @@ class FunctionMessage(Function):
         self.suppress_embeds = False
         self.silent = False
         self.has_condition = False
+        self.attachment_paths = {}
 
         if isinstance(arguments, str):
             self.content = arguments
@@ -966,10 +2003,21 @@ class FunctionMessage(Function):
         if isinstance(arguments["content"], str): arguments["content"] = [{"text": arguments["content"]}]
         if not isinstance(arguments["content"], list): raise TypeError(f"Content must be string or a list.\nTrace: {self.execution_path} -> content")
 
-        view = VeiwGenerator(self)
+        view = None
+        if not await self.render_in_worker(arguments["content"]):
+            view = VeiwGenerator(self)
+            if self.render_cache is None and any(key in ["select", "button"] for key, _ in walk_yaml(arguments["content"])): self.render_cache = {}
+            self.render_content(arguments["content"], view)
+
+        if self.embeds and len(self.embeds) == 1: self.embed = self.embeds.pop()
+        if self.files and len(self.files) == 1: self.file = self.files.pop()
+
+        if view and view.is_valid(): self.view = view.view
+
+    def render_content(self, items: list, view) -> None:
         content_count: dict[str, int] = {}
 
-        for item in arguments["content"]:
+        for item in items:
             if item and isinstance(item, dict) and "condition" in item:
                 item = self.evaluate_condition(item["condition"])
                 self.has_condition = True
@@ -988,19 +2036,101 @@ class FunctionMessage(Function):
 
 
             match content_type:
-                case "text": self.content = self.evaluate_string(item["text"])
-                case "embed": self.embeds.append(self.create_embed(item["embed"], trace))
-                case "select": view.add_select(item[content_name], trace)
-                case "button": view.add_button(item[content_name], trace)
+                case "text": self.content, _ = self.render_item(trace, item, [(item["text"], True)], lambda: self.evaluate_string(item["text"]))
+                case "embed":
+                    embed, _ = self.render_item(trace, item, embed_sources(item["embed"]), lambda: self.create_embed(item["embed"], trace))
+                    self.embeds.append(embed)
+                case "select":
+                    select, reused = self.render_item(trace, item, select_sources(item[content_name]), lambda: view.add_select(item[content_name], trace))
+                    if reused and select: view.view.add_item(select)
+                case "button":
+                    button, reused = self.render_item(trace, item, [], lambda: view.add_button(item[content_name], trace))
+                    if reused and button: view.view.add_item(button)
+                case "file" | "attachment": self.attach(item[content_name], trace)
                 case _: raise NameError(f"'{content_name}' is not a recognised message content type.\nTrace: {self.execution_path} -> content -> ?")
 
-        if self.embeds and len(self.embeds) == 1: self.embed = self.embeds.pop()
-        if self.files and len(self.files) == 1: self.file = self.files.pop()
+    # When a message is rendered again after an interaction, items that come from the same
+    # YAML and read the same values are reused, components keep their Interaction
+    def render_item(self, trace: str, item: dict, sources: list, render) -> tuple[Any, bool]:
+        if self.render_cache is None: return render(), False
+        key = self.dependency_key(sources)
+        cached = self.render_cache.get(trace)
+        if key is not None and cached and cached[0] is item and cached[1] == key:
+            metrics.increment("render.reused")
+            return cached[2], True
+        result = render()
+        self.render_cache[trace] = (item, key, result)
+        return result, False
+
+    # Text and embeds are rendered in a worker process when the message has no components
+    async def render_in_worker(self, items: list) -> bool:
+        if not render_workers: return False
+        if any(key in ["select", "button", "file", "attachment"] or key in ["image", "thumbnail"] and is_local_file(value) for key, value in walk_yaml(items)): return False
+        if not all(is_plain(value) for value in self.additional_variables.values()): return False
+
+        logging.debug("Rendering in worker: %s", self.execution_path)
+        values = {name: self.variable(name) for name in variables.scopes}
+        descriptor = {
+            "path": self.execution_path,
+            "content": items,
+            "channel": Snapshot(self.channel) if self.channel else None,
+            "user": Snapshot(self.user) if self.user else None,
+            "guild": Snapshot(self.guild) if self.guild else None,
+            "extra": self.additional_variables,
+            "variables": {name: value for name, value in values.items() if is_plain(value)}
+        }
+        try:
+            rendered = await asyncio.get_running_loop().run_in_executor(get_render_pool(), render_message, descriptor)
+        except Exception as e:
+            logging.error("Rendering in worker failed: %s", e)
+            return False
 
-        if view.is_valid(): self.view = view.view
+        self.content = rendered["content"]
+        self.embeds = [discord.Embed.from_dict(embed) for embed in rendered["embeds"]]
+        self.has_condition = rendered["has_condition"]
+        return True
 
+    # A local file, either a path or {path, name, spoiler, description}. Returns the filename
+    def attach(self, data: str | dict, trace: str) -> str:
+        if isinstance(data, str): data = {"path": data}
+        if not isinstance(data, dict) or "path" not in data: raise TypeError(f"File must be a path or a dictionary with a path.\nTrace: {trace}")
+        path = str(data["path"])
+        if path in self.attachment_paths.values():
+            return next(filename for filename, x in self.attachment_paths.items() if x == path)
+        if not os.path.isfile(path): raise FileNotFoundError(f"'{path}' does not exist.\nTrace: {trace}")
+
+        file = attachments.file(path, data.get("name"), bool(data.get("spoiler", False)), data.get("description"))
+        self.files.append(file)
+        self.attachment_paths[file.filename] = path
+        return file.filename
+
+    # Local images are uploaded with the message the first time and linked from the CDN after that
+    def embed_image(self, value: str, trace: str) -> str:
+        if not is_local_file(value): return value
+        return attachments.url(value) or "attachment://" + self.attach(value, trace)
+
+    # Embeds are memoised by the values their templates read, so a static embed is built once
+    # and a dynamic one again only when one of its variables changed
     def create_embed(self, data, trace: str) -> discord.Embed:
         if not isinstance(data, dict): raise TypeError(f"Embed must be a dictionary.\nTrace: {trace}")
+        key = self.dependency_key(embed_sources(data))
+        if key is None: return self.build_embed(data, trace)
+
+        # The YAML is kept in the entry so its id can not be reused by another dictionary
+        cache_key = (id(data), key)
+        cached = embed_cache.get(cache_key)
+        if cached:
+            embed_cache.move_to_end(cache_key)
+            metrics.increment("embeds.cached")
+            return cached[1]
+
+        metrics.increment("embeds.built")
+        embed = self.build_embed(data, trace)
+        embed_cache[cache_key] = (data, embed)
+        if len(embed_cache) > EMBED_CACHE_SIZE: embed_cache.popitem(last=False)
+        return embed
+
+    def build_embed(self, data: dict, trace: str) -> discord.Embed:
         new_embed = discord.Embed(
             colour=self.get_colour(data.get("colour")),
             title=self.evaluate_string(data.get("title")),
@@ -1020,7 +2150,9 @@ class FunctionMessage(Function):
             )
         
         if "thumbnail" in data:
-            new_embed.set_thumbnail(url=data["thumbnail"])
+            new_embed.set_thumbnail(url=self.embed_image(data["thumbnail"], trace + " -> thumbnail"))
+        if "image" in data:
+            new_embed.set_image(url=self.embed_image(data["image"], trace + " -> image"))
 
         footer = data.get("footer")
         if not footer: return new_embed
@@ -1029,6 +2161,32 @@ class FunctionMessage(Function):
         new_embed.set_footer(text=self.evaluate_string(footer.get("text")), icon_url=self.evaluate_string(footer.get("icon")))
         return new_embed
 
+# Built embeds are shared between messages and must not be changed after they are built
+EMBED_CACHE_SIZE = 1024
+embed_cache: OrderedDict[tuple, tuple[dict, discord.Embed]] = OrderedDict()
+
+# Strings of an embed that are evaluated, None when the embed attaches local files
+def embed_sources(data: dict) -> list[tuple[Any, bool]]:
+    if not isinstance(data, dict): return None
+    if any(is_local_file(data.get(key)) for key in ["image", "thumbnail"]): return None
+    sources = [(data.get(key), True) for key in ["title", "type", "url", "description"]]
+    for field in data.get("fields") or []:
+        if not isinstance(field, dict): return None
+        sources += [(field.get("name"), True), (field.get("value"), True)]
+    footer = data.get("footer")
+    if isinstance(footer, dict): sources += [(footer.get("text"), True), (footer.get("icon"), True)]
+    elif footer: sources.append((footer, True))
+    # A colour can be the name of a variable
+    if isinstance(data.get("colour"), str): sources.append((data["colour"], False))
+    return sources
+
+# Defaults of select options are expressions
+def select_sources(data: dict | list) -> list[tuple[Any, bool]]:
+    options = data.get("options") if isinstance(data, dict) else data
+    if not isinstance(options, list): return []
+    return [(option["default"], False) for option in options if isinstance(option, dict) and isinstance(option.get("default"), str)]
+
+
 class FunctionSendMessage(FunctionMessage):
     async def execute(self) -> bool:
         await super().execute()
@@ -1038,21 +2196,90 @@ class FunctionSendMessage(FunctionMessage):
 
 class FunctionUpdateMessage(FunctionMessage):
     async def execute(self) -> bool:
+        arguments = self.raw_function[self.function_name]
+        debounce = arguments.get("debounce") if isinstance(arguments, dict) else None
+        if not debounce: return await self.update()
+
+        if isinstance(debounce, dict):
+            quiet = to_seconds(debounce.get("quiet", debounce.get("wait")))
+            max_wait = to_seconds(yaml_get(debounce, "max wait"))
+        else:
+            quiet = to_seconds(debounce)
+            max_wait = to_seconds(yaml_get(arguments, "max wait"))
+        message_debouncer.schedule(self, quiet or 0, max_wait)
+        return True
+
+    async def update(self) -> bool:
         await super().execute()
         if not self.channel: return False
         self.msg = await save_data.get_message(self)
 
         if not self.msg:
             await self.send()
+            metrics.increment("update_message.sent")
             save_data.save_msg(self)
             return True
 
         if self.compare_to(self.msg): return False
         await self.edit()
+        metrics.increment("update_message.edits")
 
         save_data.save_msg(self)
         return True
 
+
+class PendingUpdate:
+    def __init__(self, func: FunctionUpdateMessage, due: float, last_due: float) -> None:
+        self.func = func
+        self.due = due
+        self.last_due = last_due
+
+
+# Updates of the same message wait for a quiet period and only the latest one is rendered
+class MessageDebouncer:
+    def __init__(self) -> None:
+        self.pending: dict[str, PendingUpdate] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def schedule(self, func: FunctionUpdateMessage, quiet: float, max_wait: float = None) -> None:
+        now = asyncio.get_running_loop().time()
+        entry = self.pending.get(func.execution_path)
+        if entry:
+            logging.debug("Coalescing update: %s", func.execution_path)
+            metrics.increment("update_message.coalesced")
+            entry.func = func
+            entry.due = min(now + quiet, entry.last_due)
+            return
+
+        logging.debug("Debouncing update: %s", func.execution_path)
+        last_due = now + max_wait if max_wait else float("inf")
+        self.pending[func.execution_path] = PendingUpdate(func, min(now + quiet, last_due), last_due)
+        task = asyncio.create_task(self.flush(func.execution_path))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, execution_path: str) -> None:
+        loop = asyncio.get_running_loop()
+        entry = self.pending[execution_path]
+        while entry.due > loop.time():
+            await asyncio.sleep(entry.due - loop.time())
+        del self.pending[execution_path]
+
+        lock = self.locks.setdefault(execution_path, asyncio.Lock())
+        async with lock:
+            try:
+                await entry.func.update()
+            except Exception as e:
+                logging.error("Debounced update failed: %s", e)
+
+    # Waits until every pending update has been made
+    async def join(self) -> None:
+        while self.tasks: await asyncio.gather(*self.tasks)
+
+
+message_debouncer = MessageDebouncer()
+
 class FunctionResponseMessage(FunctionMessage):
     ephemeral = True
     response: discord.InteractionResponse = None
@@ -1098,12 +2325,15 @@ class FunctionResponseMessage(FunctionMessage):
 
         if use_response: self.msg = await self.response.send_message(self.content, **args)
         else: self.msg = await self.followup.send(self.content, **args)
+
+        extras = self.additional_variables.get("extras")
+        if isinstance(extras, dict): extras["responded"] = True
         return True
     
 
 class FunctionWait(Function):
     time: datetime = None
-    do: list[dict] = []
+    do: list[dict] = None
 
     async def find_arguments(self, arguments) -> None:
         self.time = None
@@ -1127,9 +2357,9 @@ class FunctionWait(Function):
 
         time = arguments["time"]
         if not isinstance(time, str): raise TypeError(f"Time must be a string.\nTrace: {self.execution_path}")
-        if time in yaml_variables: time = self.evaluate(time)
+        if time in variables: time = self.variable(time)
         
-        td = string_to_timedelta(arguments["time"])
+        td = string_to_timedelta(time)
         if td.total_seconds() <= 0: raise ValueError("Time must have more than 0 seconds.")
         self.time = utcnow() + td
 
@@ -1151,6 +2381,194 @@ class FunctionWait(Function):
 
 
 
+# ---------- Render Workers ---------- #
+
+# Handlers still run on the gateway loop, but the eval heavy rendering of
+# message text and embeds can be sent to a pool of worker processes
+execution: dict = yaml.get("execution") or {}
+render_workers: int = int(execution.get("workers", 0))
+render_pool: "ProcessPoolExecutor" = None
+
+# multiprocessing is only imported when the first message is rendered in a worker
+def get_render_pool() -> "ProcessPoolExecutor":
+    global render_pool
+    if not render_pool:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        logging.info("Starting %s render workers", render_workers)
+        render_pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn"))
+    return render_pool
+
+PLAIN_TYPES = (str, int, float, bool, type(None), datetime, timedelta)
+
+def is_plain(value: Any) -> bool:
+    if isinstance(value, PLAIN_TYPES): return True
+    if isinstance(value, (list, tuple)): return all(is_plain(x) for x in value)
+    if isinstance(value, dict): return all(isinstance(k, str) and is_plain(v) for k, v in value.items())
+    return False
+
+
+# Picklable copy of the attributes templates usually read from a channel, user or guild
+class Snapshot:
+    ATTRIBUTES = [
+        "id", "name", "mention", "display_name", "global_name", "nick", "discriminator", "bot",
+        "created_at", "joined_at", "jump_url", "topic", "position", "member_count", "description",
+        "role_count", "category_count", "forum_count", "channel_count", "emoji_count", "event_count",
+        "stage_channel_count", "stage_instance_count", "sticker_count", "text_channel_count",
+        "thread_count", "voice_channel_count"
+    ]
+
+    def __init__(self, obj: Any) -> None:
+        self.text = str(obj)
+        for key in self.ATTRIBUTES:
+            try:
+                value = getattr(obj, key)
+            except Exception:
+                continue
+            if isinstance(value, PLAIN_TYPES): setattr(self, key, value)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class RenderFunction(FunctionMessage):
+    variable_values: dict = None
+
+    def __init__(self, descriptor: dict) -> None:
+        self.channel = descriptor["channel"]
+        self.user = descriptor["user"]
+        self.guild = descriptor["guild"]
+        self.raw_function = {}
+        self.function_name = ""
+        self.execution_path = descriptor["path"]
+        self.additional_variables = descriptor["extra"]
+        self.variable_values = descriptor["variables"]
+        self.content = ""
+        self.embeds = []
+        self.files = []
+        self.attachment_paths = {}
+        self.has_condition = False
+
+    def variable(self, name: str) -> Any:
+        return self.variable_values.get(name.replace(" ", "_"))
+
+    def variable_mapping(self) -> Mapping:
+        return self.variable_values
+
+
+def render_message(descriptor: dict) -> dict:
+    func = RenderFunction(descriptor)
+    func.render_content(descriptor["content"], None)
+    return {
+        "content": func.content,
+        "embeds": [embed.to_dict() for embed in func.embeds],
+        "has_condition": func.has_condition
+    }
+
+
+
+
+
+
+
+
+
+# ---------- Cooldowns ---------- #
+
+# Token buckets keyed by user, channel, guild or nothing (global).
+# Buckets are ordered by when they were last used, a bucket that has been idle
+# long enough to be full again is the same as no bucket so it is evicted.
+class Cooldown:
+    def __init__(self, settings: dict, trace: str = "") -> None:
+        self.settings = settings
+        self.per = str(settings.get("per", "user")).lower()
+        if self.per not in ["user", "channel", "guild", "global"]:
+            logging.error("Invalid cooldown key '%s', using user", self.per)
+            self.per = "user"
+
+        # Rates are either tokens per second or a string like '3/10s'
+        rate = settings.get("rate", 1)
+        if isinstance(rate, str) and "/" in rate:
+            count, duration = rate.split("/", 1)
+            if not re.match(r"\s*\d", duration): duration = "1" + duration
+            count = float(count)
+            self.rate = count / (to_seconds(duration) or 1)
+        else:
+            count = float(rate)
+            self.rate = count
+        if self.rate <= 0:
+            logging.critical("Cooldown rate is not greater than 0: %s", rate)
+            raise ValueError(f"The rate of a cooldown must be greater than 0, got '{rate}'.\nTrace: {trace} -> rate")
+        self.burst = float(settings.get("burst", max(count, 1)))
+        self.idle = self.burst / self.rate
+        self.buckets: OrderedDict[int, list[float]] = OrderedDict()
+
+    def key(self, channel: discord.TextChannel = None, user: discord.abc.User = None, guild: discord.Guild = None) -> int:
+        match self.per:
+            case "user": return user.id if user else None
+            case "channel": return channel.id if channel else None
+            case "guild": return guild.id if guild else None
+        return None
+
+    # Takes a token, returns 0 if there was one or else the seconds until there is
+    def take(self, key: int) -> float:
+        now = time.monotonic()
+        while self.buckets:
+            oldest = next(iter(self.buckets))
+            if now - self.buckets[oldest][1] < self.idle: break
+            self.buckets.popitem(last=False)
+
+        bucket = self.buckets.pop(key, None)
+        if bucket is None: bucket = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        self.buckets[key] = bucket
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return (1 - tokens) / self.rate
+
+
+cooldown_settings: dict = yaml.get("cooldowns") or {}
+if not isinstance(cooldown_settings, dict):
+    logging.critical("Cooldowns is of type '%s' and not 'dict'", type(cooldown_settings))
+    raise TypeError("'cooldowns' must be a dictionary.")
+cooldowns: dict[str, Cooldown] = {}
+
+# Components with the same execution path share their cooldown across messages
+def get_cooldown(path: str, settings: dict = None) -> Cooldown:
+    if path in cooldowns: return cooldowns[path]
+    trace = f"{path} -> cooldown"
+    if settings is None:
+        settings = yaml_get(cooldown_settings, path)
+        trace = f"cooldowns -> {path}"
+    if not isinstance(settings, dict): return None
+    cooldowns[path] = Cooldown(settings, trace)
+    return cooldowns[path]
+
+# Cooldowns of events are created up front so an invalid one stops the startup
+for event in cooldown_settings: get_cooldown(event.replace("_", " "))
+
+# Returns False when the event is on cooldown, its on cooldown section is run instead
+def check_cooldown(event: str, channel: discord.TextChannel = None, user: discord.abc.User = None, guild: discord.Guild = None) -> bool:
+    cooldown = get_cooldown(event)
+    if not cooldown: return True
+    retry_after = cooldown.take(cooldown.key(channel, user, guild))
+    if not retry_after: return True
+
+    logging.info("'%s' is on cooldown for %.1fs", event, retry_after)
+    metrics.increment(f"cooldowns.{event}")
+    # Without a user the reply can not replace the queued event it is about when events are coalesced
+    if has_section("on cooldown", cooldown.settings):
+        dispatcher.submit(guild.id if guild else None, None, lambda: run_event("on cooldown", channel, user, guild, cooldown.settings, event + " -> ", {"retry_after": retry_after}))
+    return False
+
+
+
+
+
+
 # ---------- View and Interactions ---------- #
 
 
@@ -1159,11 +2577,19 @@ interactions = []
 
 
 
+# Interactions expire after 3 seconds, slow handlers are deferred before that
+interaction_settings: dict = yaml.get("interactions") or {}
+DEFER_AFTER: float = to_seconds(yaml_get(interaction_settings, "defer after", 2))
+
 class Interaction:
-    code = {}
+    code = None
     execution_path = ""
     item = None
     func = None
+    functions: list = None
+    defer = False
+    defer_after: float = None
+    cooldown: Cooldown = None
 
     def __init__(self, item, code: dict, trace: str, func = None) -> None:
         logging.info("Listening to interaction: %s", trace)
@@ -1172,28 +2598,33 @@ class Interaction:
         self.item = item
         self.func = func
 
+        self.functions = yaml_get(code, "on interaction", [])
+        if not isinstance(self.functions, list):
+            logging.error("On interaction is of type '%s' and not 'list'", type(self.functions))
+            self.functions = None
+        self.defer = any(isinstance(x, dict) and "defer" in x for x in self.functions or [])
+        self.defer_after = to_seconds(yaml_get(code, "defer after", DEFER_AFTER))
+        cooldown = yaml_get(code, "cooldown")
+        self.cooldown = get_cooldown(trace, cooldown) if isinstance(cooldown, dict) else None
+
 
     async def interact(self, interaction: discord.Interaction) -> None:
         logging.info("Interaction: %s", self.execution_path)
         logging.debug("User: %s", interaction.user)
+        recorder.interaction(interaction, self.execution_path)
         
-        functions = self.code.get("on interaction", [])
-        if not functions: functions = self.code.get("on_interaction", [])
-        if not isinstance(functions, list):
-            logging.error("On interaction is of type '%s' and not 'list'", type(functions))
-            return
+        if self.functions is None: return
+
+        if self.cooldown:
+            retry_after = self.cooldown.take(self.cooldown.key(interaction.channel, interaction.user, interaction.guild))
+            if retry_after:
+                await self.reject(interaction, retry_after)
+                return
 
         if self.func: await self.func.refresh()
 
-        defer = False
-        for func in functions:
-            for key in func:
-                if key == "defer":
-                    defer = True
-                    break
-            if defer: break
-        
-        if defer:
+        deferred = self.defer
+        if self.defer:
             logging.info("Response is deferred")
             await interaction.response.defer()
         
@@ -1203,7 +2634,7 @@ class Interaction:
                 if key.startswith("_"): continue
                 args[key] = getattr(obj, key)
         
-        await run_code(
+        handler = asyncio.ensure_future(run_event(
             "on interaction",
             interaction.channel,
             interaction.user,
@@ -1211,10 +2642,22 @@ class Interaction:
             self.code,
             self.execution_path,
             args
-        )
+        ))
+
+        # Responses made after this go through the followup webhook
+        done, _ = await asyncio.wait({handler}, timeout=self.defer_after)
+        if not done and not interaction.response.is_done():
+            logging.info("Interaction is slow, deferring the response")
+            metrics.increment("interactions.auto_deferred")
+            try:
+                await interaction.response.defer()
+                deferred = True
+            except discord.InteractionResponded:
+                logging.debug("Interaction was responded to while deferring")
+        await handler
 
 
-        if interaction.response.is_done():
+        if interaction.extras.get("responded") or (interaction.response.is_done() and not deferred):
             logging.debug("Interaction was responded to")
             return
 
@@ -1226,11 +2669,24 @@ class Interaction:
         if isinstance(self.func, FunctionMessage) and self.func.has_condition:
             logging.info("Responding to interaction by editing the message")
             await self.func.find_arguments(self.func.raw_function[self.func.function_name])
-            await interaction.response.edit_message(**self.func.get_edit_args())
-        else:
+            if deferred:
+                args = self.func.get_edit_args(interaction.message)
+                args.pop("delete_after", None)
+                await interaction.edit_original_response(**args)
+            else: await interaction.response.edit_message(**self.func.get_edit_args(interaction.message))
+        elif not deferred:
             logging.info("Interaction was not responded to, sending default response")
             await interaction.response.send_message("Done.", ephemeral=True)
 
+    # Spam is answered before anything is refreshed or evaluated
+    async def reject(self, interaction: discord.Interaction, retry_after: float) -> None:
+        logging.info("Interaction is on cooldown for %.1fs: %s", retry_after, self.execution_path)
+        metrics.increment("cooldowns.interactions")
+        if has_section("on cooldown", self.cooldown.settings):
+            args = {"response": interaction.response, "followup": interaction.followup, "extras": interaction.extras, "retry_after": retry_after}
+            await run_event("on cooldown", interaction.channel, interaction.user, interaction.guild, self.cooldown.settings, self.execution_path + " -> ", args)
+        if not interaction.response.is_done(): await interaction.response.defer()
+
 
 
 
@@ -1249,7 +2705,7 @@ class VeiwGenerator:
         return len(self.view.children) > 0
 
 
-    def add_select(self, data: dict | list, trace: str = "") -> None:
+    def add_select(self, data: dict | list, trace: str = "") -> discord.ui.Select:
         select = discord.ui.Select()
         if not trace: trace = self.func.execution_path
         logging.info("Adding select: %s", trace)
@@ -1307,9 +2763,10 @@ class VeiwGenerator:
         interactions.append(interaction)
 
         self.view.add_item(select)
+        return select
 
 
-    def add_button(self, data: dict, trace: str = "") -> None:
+    def add_button(self, data: dict, trace: str = "") -> discord.ui.Button:
         button = discord.ui.Button()
         if not trace: trace = self.func.execution_path
         logging.info("Adding button: %s", trace)
@@ -1345,6 +2802,7 @@ class VeiwGenerator:
         interactions.append(interaction)
 
         self.view.add_item(button)
+        return button
 
 
 
@@ -1360,6 +2818,12 @@ class VeiwGenerator:
 
 # Not sure if this should be in a class
 async def run_code(code_path: str, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, lookup=None, trace="", extra_data:dict={}) -> None:
+    if profiler.wants(trace + code_path):
+        await profiler.capture(trace + code_path, execute_code(code_path, channel, user, guild, lookup, trace, extra_data))
+        return
+    await execute_code(code_path, channel, user, guild, lookup, trace, extra_data)
+
+async def execute_code(code_path: str, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, lookup=None, trace="", extra_data:dict={}) -> None:
     if not lookup: lookup = yaml
     
     for code_path_variant in [code_path, code_path.replace(" ", "_")]:
@@ -1369,81 +2833,711 @@ async def run_code(code_path: str, channel: discord.TextChannel = None, user: di
         if isinstance(raw_code, dict): raw_code = [raw_code]
         if not raw_code: return
 
-        functions: dict[str, int] = {}
+        context = ExecutionContext(channel, user, guild, extra_data.copy())
 
         for raw_function in raw_code:
-            func = Function(raw_function, channel, user, guild, trace + code_path)
-            if func.function_name in functions:
-                functions[func.function_name] += 1
-                func.execution_path += " " + str(functions[func.function_name])
-            else: functions[func.function_name] = 1
+            func = Function(raw_function, execution_path=trace + code_path, context=context)
+            context.number(func)
+            await run_function(func)
+        break
+
+
+
+
+
+# ---------- Profiling ---------- #
+
+PROFILE_ENV = "DISCORD_YAML_PROFILE"
+
+# Captures cProfile stats of selected execution paths, at most max_captures in total.
+# The profiler sees everything the event loop runs while the capture is active,
+# so only one capture runs at a time.
+class Profiler:
+    def __init__(self, enabled: bool = False, events: list[str] = None, sample_rate: float = 1, max_captures: int = 100, top: int = 25, directory: str = "profiles") -> None:
+        self.enabled = enabled
+        self.events = events
+        self.sample_rate = sample_rate
+        self.max_captures = max_captures
+        self.top = top
+        self.directory = directory
+        self.captures = 0
+        self.active = False
+        # cProfile and pstats are imported by the first capture
+        self.totals: dict[str, "pstats.Stats"] = {}
+
+    def wants(self, path: str) -> bool:
+        if not self.enabled or self.active: return False
+        if self.captures >= self.max_captures: return False
+        if self.events and not any(path.startswith(event) for event in self.events): return False
+        return random.random() < self.sample_rate
+
+    async def capture(self, path: str, code) -> None:
+        self.active = True
+        self.captures += 1
+        event = path.split(" -> ")[0]
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await code
+        finally:
+            profile.disable()
+            self.active = False
+            self.save(event, profile)
+
+    def save(self, event: str, profile: "cProfile.Profile") -> None:
+        import pstats
+        name = re.sub(r"\W+", "_", event).strip("_") or "event"
+        os.makedirs(self.directory, exist_ok=True)
+        file = os.path.join(self.directory, f"{name}-{self.captures}{shard_suffix()}.pstats")
+        profile.dump_stats(file)
+        logging.info("Saved profile: %s", file)
+        metrics.increment("profiles.captured")
+
+        if event in self.totals: self.totals[event].add(profile)
+        else: self.totals[event] = pstats.Stats(profile)
+
+        summary = io.StringIO()
+        stats = self.totals[event]
+        stats.stream = summary
+        stats.sort_stats("cumulative").print_stats(self.top)
+        with open(os.path.join(self.directory, f"{name}{shard_suffix()}.txt"), "w") as file:
+            file.write(f"{event}\n")
+            file.write(summary.getvalue())
+
+        if self.captures >= self.max_captures: logging.warn("Reached the maximum amount of profiles: %s", self.max_captures)
+
+
+def create_profiler() -> Profiler:
+    settings: dict = yaml.get("profiling") or {}
+    events = yaml_get(settings, "events")
+    enabled = bool(settings.get("enabled", "profiling" in yaml))
+
+    # The environment flag is either on/all or a comma separated list of events
+    flag = os.getenv(PROFILE_ENV, "").strip()
+    if flag and flag.lower() not in ["0", "false", "off"]:
+        enabled = True
+        if flag.lower() not in ["1", "true", "on", "all"]: events = flag.split(",")
+
+    if isinstance(events, str): events = [events]
+    if events == ["all"]: events = None
+    return Profiler(
+        enabled,
+        [event.strip() for event in events] if events else None,
+        float(yaml_get(settings, "sample rate", 1)),
+        int(yaml_get(settings, "max captures", 100)),
+        int(settings.get("top", 25)),
+        settings.get("directory", "profiles")
+    )
+
+profiler = create_profiler()
+
+
+
+
+
+# ---------- Deadlines ---------- #
+
+deadline_settings: dict = yaml.get("deadlines") or {}
+function_deadlines: dict = {str(key).lower().replace("_", " "): value for key, value in (deadline_settings.get("functions") or {}).items()}
+
+def event_deadline(event: str) -> float:
+    return to_seconds(yaml_get(deadline_settings, event, deadline_settings.get("default")))
+
+def function_deadline(func: Function) -> float:
+    value = func.raw_function.get("timeout")
+    if value is None: value = function_deadlines.get(func.function_name.lower().replace("_", " "))
+    return to_seconds(value)
+
+# Paths of loops contain guild IDs, so they are only logged and not used as metric names
+def record_timeout(execution_path: str) -> None:
+    logging.error("Timed out: %s", execution_path)
+    metrics.increment("timeouts")
+
+
+async def run_function(func: Function) -> None:
+    timeout = function_deadline(func)
+    if not timeout:
+        await func.execute()
+        return
+
+    try:
+        await asyncio.wait_for(func.execute(), timeout)
+    except asyncio.TimeoutError:
+        record_timeout(func.execution_path)
+        if has_section("on timeout", func.raw_function):
+            await run_code("on timeout", func.channel, func.user, func.guild, func.raw_function, func.execution_path + " -> ", func.additional_variables)
+
+
+# Runs a whole section, cancelling everything nested in it when the deadline passes
+async def run_event(event: str, channel: discord.TextChannel = None, user: discord.Member | discord.User = None, guild: discord.Guild = None, lookup=None, trace="", extra_data: dict = None, code_path: str = None) -> bool:
+    if extra_data is None: extra_data = {}
+    code = run_code(code_path or event, channel, user, guild, lookup, trace, extra_data)
+    timeout = event_deadline(event)
+    if not timeout:
+        await code
+        return True
+
+    try:
+        await asyncio.wait_for(code, timeout)
+        return True
+    except asyncio.TimeoutError:
+        record_timeout(trace + (code_path or event))
+        if event != "on timeout" and has_section("on timeout"):
+            await run_event("on timeout", channel, user, guild, extra_data={**extra_data, "timed_out": event})
+        return False
+
+
+
+
+# ---------- Dispatcher ---------- #
+
+class Lane:
+    def __init__(self) -> None:
+        self.queue: deque[list] = deque()
+        self.users: dict[int, list] = {}
+        self.running = 0
+
+
+# Events are queued per guild so a busy guild cannot starve the others
+class Dispatcher:
+    OVERFLOW_POLICIES = ["drop oldest", "drop newest", "coalesce"]
+
+    def __init__(self, global_limit: int = 100, guild_limit: int = 4, queue_size: int = 1000, overflow: str = "drop oldest") -> None:
+        logging.info("Initialising the Dispatcher")
+        if overflow not in self.OVERFLOW_POLICIES:
+            logging.critical("Invalid overflow policy: %s", overflow)
+            raise ValueError(f"'{overflow}' is not a valid overflow policy. Use {self.OVERFLOW_POLICIES}.")
+        self.guild_limit = guild_limit
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.semaphore = asyncio.Semaphore(global_limit)
+        self.lanes: dict[int, Lane] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.queued = 0
+        self.running = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def submit(self, guild_id: int, user_id: int, job) -> bool:
+        lane = self.lanes.get(guild_id)
+        if not lane: lane = self.lanes[guild_id] = Lane()
+
+        # Only the latest event of a user waiting in the queue is kept
+        if self.overflow == "coalesce" and user_id in lane.users:
+            logging.debug("Coalescing event for user: %s", user_id)
+            lane.users[user_id][1] = job
+            metrics.increment("dispatch.coalesced")
+            return True
+
+        if len(lane.queue) >= self.queue_size:
+            metrics.increment("dispatch.dropped")
+            if self.overflow == "drop newest":
+                logging.warning("Queue for guild %s is full, dropping event", guild_id)
+                return False
+            logging.warning("Queue for guild %s is full, dropping oldest event", guild_id)
+            self.pop(lane)
+
+        entry = [user_id, job]
+        lane.queue.append(entry)
+        if user_id is not None: lane.users[user_id] = entry
+        self.queued += 1
+        self.idle.clear()
+        metrics.set("dispatch.queued", self.queued)
+        metrics.set("dispatch.max_guild_queue", max(metrics.gauges.get("dispatch.max_guild_queue", 0), len(lane.queue)))
+
+        if lane.running < self.guild_limit:
+            lane.running += 1
+            task = asyncio.create_task(self.drain(guild_id, lane))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return True
+
+    def pop(self, lane: Lane) -> list:
+        entry = lane.queue.popleft()
+        if lane.users.get(entry[0]) is entry: del lane.users[entry[0]]
+        self.queued -= 1
+        return entry
+
+    async def drain(self, guild_id: int, lane: Lane) -> None:
+        try:
+            while lane.queue:
+                entry = self.pop(lane)
+                async with self.semaphore:
+                    self.running += 1
+                    metrics.set("dispatch.running", self.running)
+                    try:
+                        await entry[1]()
+                    except Exception as e:
+                        logging.error("Event failed: %s", e)
+                        metrics.increment("dispatch.failed")
+                    finally:
+                        self.running -= 1
+        finally:
+            lane.running -= 1
+            if not lane.running and not lane.queue and self.lanes.get(guild_id) is lane: del self.lanes[guild_id]
+            metrics.set("dispatch.queued", self.queued)
+            metrics.set("dispatch.running", self.running)
+            if not self.lanes: self.idle.set()
+
+    # Waits until every queued event has been handled
+    async def join(self) -> None:
+        await self.idle.wait()
+
+
+dispatch_settings: dict = yaml.get("dispatch") or {}
+dispatcher = Dispatcher(
+    int(yaml_get(dispatch_settings, "global concurrency", 100)),
+    int(yaml_get(dispatch_settings, "guild concurrency", 4)),
+    int(yaml_get(dispatch_settings, "queue size", 1000)),
+    str(dispatch_settings.get("overflow", "drop oldest")).lower().replace("_", " ")
+)
+
+
+
+
+
+# ---------- Batching ---------- #
+
+# Members that join or leave a guild within the window are handled by one run of the
+# event with a 'users' list, a batch is run early once it reaches max
+class Batcher:
+    def __init__(self, event: str, settings: dict) -> None:
+        self.event = event
+        self.window: float = to_seconds(settings.get("window", 5)) or 5
+        self.max = int(settings.get("max", 50))
+        self.pending: dict[int, dict[int, discord.Member]] = {}
+        self.timers: dict[int, asyncio.TimerHandle] = {}
+
+    def add(self, member: discord.Member) -> None:
+        guild_id = member.guild.id
+        members = self.pending.setdefault(guild_id, {})
+        # A member that shows up twice is only handled once, with the latest state
+        members.pop(member.id, None)
+        members[member.id] = member
+
+        if len(members) >= self.max: self.flush(guild_id)
+        elif guild_id not in self.timers:
+            self.timers[guild_id] = asyncio.get_running_loop().call_later(self.window, self.flush, guild_id)
+
+    def flush(self, guild_id: int) -> None:
+        timer = self.timers.pop(guild_id, None)
+        if timer: timer.cancel()
+        members = list(self.pending.pop(guild_id, {}).values())
+        if not members: return
+
+        logging.info("Running '%s' for a batch of %s users", self.event, len(members))
+        metrics.observe(f"batch.{self.event}", len(members))
+        guild = members[0].guild
+        dispatcher.submit(guild_id, None, lambda: run_event(self.event, None, None, guild, yaml_get(yaml, self.event), self.event + " -> ", {"users": members}, code_path="do"))
+
+
+# Opt in with 'on user joined: {batch: {window: 5s, max: 50}, do: [...]}'
+batchers: dict[str, Batcher] = {}
+for event in ["on user joined", "on user left"]:
+    section = yaml_get(yaml, event)
+    if isinstance(section, dict) and isinstance(section.get("batch"), dict):
+        logging.info("Batching '%s': %s", event, section["batch"])
+        batchers[event] = Batcher(event, section["batch"])
+
+
+
+
+
+# ---------- App Commands ---------- #
+
+OPTION_TYPES = {
+    "string": str,
+    "text": str,
+    "integer": int,
+    "int": int,
+    "number": float,
+    "float": float,
+    "boolean": bool,
+    "bool": bool,
+    "user": discord.Member,
+    "member": discord.Member,
+    "channel": discord.abc.GuildChannel,
+    "role": discord.Role
+}
+
+app_command_settings: dict = yaml_get(yaml, "app commands") or {}
+tree: "app_commands.CommandTree" = None
+
+# Names the callback and run_app_command pass next to the options
+RESERVED_OPTIONS = ["interaction", "options", "response", "followup", "extras"]
+
+# discord.py reads the options from the callback's signature, so one is built from the YAML
+def create_app_command(name: str, data: dict) -> "app_commands.Command":
+    from discord import app_commands
+    parameters = []
+    descriptions = {}
+    for option, settings in (data.get("options") or {}).items():
+        trace = f"app commands -> {name} -> options -> {option}"
+        if option in RESERVED_OPTIONS:
+            logging.critical("Reserved option name: %s", trace)
+            raise ValueError(f"'{option}' cannot be used as an option name, it is one of {', '.join(RESERVED_OPTIONS)}.\nTrace: {trace}")
+        if not isinstance(settings, dict): settings = {"type": settings}
+        annotation = OPTION_TYPES.get(str(settings.get("type", "string")).lower())
+        if not annotation:
+            logging.error("Invalid option type '%s' in: %s", settings.get("type"), name)
+            annotation = str
+        default = inspect.Parameter.empty if settings.get("required", True) else None
+        try:
+            parameters.append(inspect.Parameter(option, inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=annotation, default=default))
+        except ValueError:
+            logging.critical("Invalid option name: %s", trace)
+            raise ValueError(f"'{option}' is not a valid option name. It can only contain letters, numbers and underscores. It cannot start with a number.\nTrace: {trace}")
+        if "description" in settings: descriptions[option] = str(settings["description"])
+
+    # Required options have to come first, the order within both groups is kept
+    parameters.sort(key=lambda x: x.default is not inspect.Parameter.empty)
+    parameters.insert(0, inspect.Parameter("interaction", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=discord.Interaction))
+
+    async def callback(interaction: discord.Interaction, **options) -> None:
+        await run_app_command(name, data, interaction, options)
+    callback.__signature__ = inspect.Signature(parameters)
+    if descriptions: app_commands.describe(**descriptions)(callback)
+
+    return app_commands.Command(name=name, description=str(data.get("description", name)), callback=callback)
+
+# The command tree is only imported and created when the YAML has app commands
+def register_app_commands() -> None:
+    global tree
+    from discord import app_commands
+    tree = app_commands.CommandTree(client)
+    for name, data in app_command_settings.items():
+        if not isinstance(data, dict):
+            logging.error("App command '%s' is not a dictionary", name)
+            continue
+        guilds = [discord.Object(int(x)) for x in data.get("guilds", [])]
+        logging.info("Registering app command: %s", name)
+        if guilds: tree.add_command(create_app_command(str(name), data), guilds=guilds)
+        else: tree.add_command(create_app_command(str(name), data))
+
+if app_command_settings: register_app_commands()
+
+
+# Same as interactions, slow commands are deferred and unanswered commands get a default response
+async def run_app_command(name: str, data: dict, interaction: discord.Interaction, options: dict) -> None:
+    logging.info("App command: %s", name)
+    metrics.increment(f"app_commands.{name}")
+    args = {**options, "options": options, "response": interaction.response, "followup": interaction.followup, "extras": interaction.extras}
+    handler = asyncio.ensure_future(run_event(
+        "app commands",
+        interaction.channel,
+        interaction.user,
+        interaction.guild,
+        data,
+        f"app commands -> {name} -> ",
+        args,
+        code_path="do"
+    ))
+
+    deferred = False
+    done, _ = await asyncio.wait({handler}, timeout=DEFER_AFTER)
+    if not done and not interaction.response.is_done():
+        logging.info("App command is slow, deferring the response")
+        await interaction.response.defer(thinking=True)
+        deferred = True
+    await handler
+
+    if interaction.extras.get("responded") or (interaction.response.is_done() and not deferred): return
+    if deferred: await interaction.followup.send("Done.", ephemeral=True)
+    else: await interaction.response.send_message("Done.", ephemeral=True)
+
+
+# Syncing is rate limited and global syncs are slow, so a scope is only synced when
+# its commands changed since the last sync
+async def sync_app_commands() -> None:
+    import hashlib
+    hashes: dict = save_data.data.setdefault("app commands", {})
+    scopes = {"global"} | set(hashes)
+    for data in app_command_settings.values():
+        if isinstance(data, dict): scopes |= {str(x) for x in data.get("guilds", [])}
+
+    for scope in sorted(scopes):
+        guild = None if scope == "global" else discord.Object(int(scope))
+        payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)), key=lambda x: x["name"])
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        if hashes.get(scope) == digest:
+            logging.info("App commands are unchanged, skipping sync: %s", scope)
+            continue
+
+        logging.info("Syncing %s app commands: %s", len(payload), scope)
+        try:
+            await tree.sync(guild=guild)
+        except discord.HTTPException as e:
+            logging.error("Syncing app commands failed: %s", e)
+            continue
+        hashes[scope] = digest
+        save_data.save()
+
+
+
+
+
+# ---------- Recording ---------- #
 
-            func.additional_variables = extra_data.copy()
+RECORD_ENV = "DISCORD_YAML_RECORD"
+
+# Writes incoming events as compact JSON lines that benchmarks/replay.py can play back.
+# IDs are replaced by the order they were first seen in and message content is only
+# kept when asked for, so recordings can be taken from production.
+class Recorder:
+    def __init__(self, path: str = None, keep_content: bool = False) -> None:
+        self.path = path
+        self.keep_content = keep_content
+        self.file = None
+        self.start: float = None
+        self.ids: dict[str, dict[int, int]] = {"g": {}, "u": {}}
+        self.channels: dict[int, dict[int, int]] = {}
+
+    def anonymise(self, kind: str, id: int) -> int:
+        ids = self.ids[kind]
+        if id not in ids: ids[id] = len(ids)
+        return ids[id]
+
+    # Channels are numbered per guild so the replay can place them in the right one
+    def anonymise_channel(self, guild: discord.Guild, channel) -> int:
+        channels = self.channels.setdefault(guild.id if guild else None, {})
+        if channel.id not in channels: channels[channel.id] = len(channels)
+        return channels[channel.id]
+
+    def record(self, event: str, guild: discord.Guild = None, channel = None, user: discord.abc.User = None, **data) -> None:
+        if not self.path: return
+        if not self.file:
+            logging.info("Recording events to: %s", self.path)
+            self.file = open(self.path, "a", buffering=1)
+            self.start = time.monotonic()
+
+        entry = {"t": round(time.monotonic() - self.start, 3), "e": event}
+        if guild: entry["g"] = self.anonymise("g", guild.id)
+        if channel: entry["c"] = self.anonymise_channel(guild, channel)
+        if user:
+            entry["u"] = self.anonymise("u", user.id)
+            if user.bot: entry["b"] = 1
+        entry.update(data)
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def message(self, message: discord.Message) -> None:
+        if not self.path: return
+        data = {"m": message.content} if self.keep_content else {"n": len(message.content)}
+        self.record("message", message.guild, message.channel, message.author, **data)
+
+    # Guild IDs in a path, like the ones of loops, are numbered like the guild of an event
+    def anonymise_path(self, execution_path: str) -> str:
+        parts = execution_path.split(" -> ")
+        for i, part in enumerate(parts):
+            if part.isdigit() and client.get_guild(int(part)): parts[i] = f"<guild {self.anonymise('g', int(part))}>"
+        return " -> ".join(parts)
+
+    def interaction(self, interaction: discord.Interaction, execution_path: str) -> None:
+        if not self.path: return
+        data = {"p": self.anonymise_path(execution_path)}
+        values = (interaction.data or {}).get("values")
+        if values: data["v"] = values
+        self.record("interaction", interaction.guild, interaction.channel, interaction.user, **data)
+
+
+record_settings: dict = yaml.get("recording") or {}
+recorder = Recorder(
+    os.getenv(RECORD_ENV) or record_settings.get("file") or (f"events{shard_suffix()}.jsonl" if "recording" in yaml else None),
+    bool(yaml_get(record_settings, "keep content", False))
+)
+
+
+
+
+
+# Bulk role updates that were interrupted by a restart continue where they stopped
+async def resume_bulk_updates() -> None:
+    for execution_path, job in list(save_data.data.get("bulk", {}).items()):
+        if job.get("guild") and not owns_guild(job["guild"]): continue
+        logging.info("Resuming bulk role update: %s", execution_path)
+        func = Function()
+        user = await func.get_user(job.get("user"))
+        server = await func.get_server(job.get("guild"))
+        channel = await func.get_channel(job.get("channel"))
+
+        func = Function(job["function"], channel, user, server)
+        func.execution_path = execution_path
+        try:
             await func.execute()
-        break
+        except Exception as e:
+            logging.error("Resuming failed: %s", e)
+
 
+# Timers that are running, so a batch that takes longer than the loop is not started twice
+running_timers: set[int] = set()
+timer_settings: dict = yaml.get("timers") or {}
+timer_concurrency: int = int(yaml_get(timer_settings, "concurrency", 10))
 
+async def resolve(coroutine) -> Any:
+    try:
+        return await coroutine
+    except discord.HTTPException as e:
+        logging.warn("Could not resolve: %s", e)
+        return None
 
+# Members that left the guild are still resolved as users
+async def resolve_timer_user(func: Function, user_id: int) -> discord.Member | discord.User:
+    user = await resolve(func.get_user(user_id))
+    if user or not func.guild: return user
+    return client.get_user(user_id) or await resolve(resolver_cache.fetch("users", user_id, lambda: client.fetch_user(user_id)))
 
+# Expired timers are grouped by guild so the guild, its members and channels are resolved once,
+# lookups that miss the cache run concurrently and are de-duplicated by the resolver cache
 async def check_timers() -> None:
     logging.info("Checking timers")
-    executed_timers: list[dict] = []
+    now = utcnow()
+    expired: dict[int, list[dict]] = {}
     for timer in save_data.get_timers():
-        if datetime.fromisoformat(timer["time"]) <= utcnow():
-            logging.info("Found expired timer: %s", timer["func"])
-            logging.debug("Data: %s", timer)
-            executed_timers.append(timer)
+        if id(timer) in running_timers: continue
+        if timer.get("guild") and not owns_guild(timer["guild"]): continue
+        if not timer.get("guild") and not is_primary_shard(): continue
+        expires = datetime.fromisoformat(timer["time"])
+        if expires > now: continue
+        logging.info("Found expired timer: %s", timer["func"])
+        logging.debug("Data: %s", timer)
+        metrics.observe("timers.delay", (now - expires).total_seconds())
+        running_timers.add(id(timer))
+        expired.setdefault(timer.get("guild"), []).append(timer)
+
+    if not expired: return
+    logging.info("Running %s expired timers in %s guilds", sum(len(x) for x in expired.values()), len(expired))
+    semaphore = asyncio.Semaphore(timer_concurrency)
+    await asyncio.gather(*(run_guild_timers(guild_id, timers, semaphore) for guild_id, timers in expired.items()))
+
+async def run_guild_timers(guild_id: int, timers: list[dict], semaphore: asyncio.Semaphore) -> None:
+    func = Function()
+    func.guild = await resolve(func.get_server(guild_id)) if guild_id else None
+
+    user_ids = list({timer["user"] for timer in timers if timer.get("user")})
+    channel_ids = list({timer["channel"] for timer in timers if timer.get("channel")})
+    users = await asyncio.gather(*(resolve_timer_user(func, user_id) for user_id in user_ids))
+    channels = await asyncio.gather(*(resolve(func.get_channel(channel_id)) for channel_id in channel_ids))
+    users = dict(zip(user_ids, users))
+    channels = dict(zip(channel_ids, channels))
+
+    await asyncio.gather(*(run_timer(timer, channels.get(timer.get("channel")), users.get(timer.get("user")), func.guild, semaphore) for timer in timers))
+
+# A timer is removed as soon as it is done, also when it failed, so it never runs twice
+async def run_timer(timer: dict, channel, user, guild, semaphore: asyncio.Semaphore) -> None:
+    async with semaphore:
+        try:
+            await run_event("timers", channel, user, guild, timer, timer["func"] + " -> ", code_path="do")
+            metrics.increment("timers.done")
+        except Exception as e:
+            logging.error("Timer failed: %s: %s", timer["func"], e)
+            metrics.increment("timers.failed")
+        finally:
+            running_timers.discard(id(timer))
+            save_data.remove_timer(timer)
 
-            func = Function()
-            user = await func.get_user(timer.get("user"))
-            server = await func.get_server(timer.get("guild"))
-            channel = await func.get_channel(timer.get("channel"))
 
-            await run_code("do", channel, user, server, timer, timer["func"] + " -> ")
-    
-    save_data.remove_timers(executed_timers)
 
 
 
+# Tasks started on ready are kept here so they are not garbage collected while running
+ready_tasks: set[asyncio.Task] = set()
 
+def start_ready_task(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    ready_tasks.add(task)
+    task.add_done_callback(ready_tasks.discard)
 
-@client.event
 async def on_ready() -> None:
-    if "on connected" not in yaml and "on_connected" not in yaml: return
     logging.info("Ready")
-    await run_code("on connected")
+    start_health_report()
+    if watchdog: watchdog.start()
+    variables.start_sync()
+    start_ready_task(resume_bulk_updates())
+    if tree and is_primary_shard(): start_ready_task(sync_app_commands())
+    if has_section("on connected") and is_primary_shard(): await run_event("on connected")
     start_loop()
 
-@client.event
 async def on_message(message: discord.Message) -> None:
-    if "on message" not in yaml and "on_message" not in yaml: return
     if message.author == client.user: return
     logging.info("Message received from: %s", message.author)
     logging.debug("Message content is not logged for privacy reasons")
-    await run_code("on message", message.channel, message.author, message.channel.guild)
+    recorder.message(message)
+    guild = message.channel.guild
+    if not check_cooldown("on message", message.channel, message.author, guild): return
+    dispatcher.submit(guild.id if guild else None, message.author.id, lambda: run_event("on message", message.channel, message.author, guild))
 
-@client.event
 async def on_member_join(member: discord.Member) -> None:
-    if "on user joined" not in yaml and "on_user_joined" not in yaml: return
     logging.info("User joined '%s': %s", member.guild.name, member)
-    await run_code("on user joined", None, member, member.guild)
+    recorder.record("join", member.guild, None, member)
+    if not check_cooldown("on user joined", None, member, member.guild): return
+    if "on user joined" in batchers:
+        batchers["on user joined"].add(member)
+        return
+    dispatcher.submit(member.guild.id, member.id, lambda: run_event("on user joined", None, member, member.guild))
 
-@client.event
 async def on_member_remove(member: discord.Member) -> None:
-    if "on user left" not in yaml and "on_user_left" not in yaml: return
     logging.info("User removed from '%s': %s", member.guild.name, member)
-    await run_code("on user left", None, member, member.guild)
+    recorder.record("remove", member.guild, None, member)
+    if not check_cooldown("on user left", None, member, member.guild): return
+    if "on user left" in batchers:
+        batchers["on user left"].add(member)
+        return
+    dispatcher.submit(member.guild.id, member.id, lambda: run_event("on user left", None, member, member.guild))
 
 @tasks.loop(minutes=1)
 async def main_loop() -> None:
     if "loop" not in yaml: return
     logging.info("Executing loop functions")
-    await run_code("do", lookup=yaml["loop"], trace="loop -> ")
+    if yaml_get(yaml["loop"], "per guild", False): start_guild_loops()
+    elif is_primary_shard(): await run_event("loop", lookup=yaml["loop"], trace="loop -> ", code_path="do")
     await check_timers()
 
 
+# Guilds whose loop is still running, a guild is skipped until its previous run is done
+guild_loops: dict[int, asyncio.Task] = {}
+guild_loop_semaphore: asyncio.Semaphore = None
+
+def loop_interval() -> float:
+    return main_loop.hours * 3600 + main_loop.minutes * 60 + main_loop.seconds
+
+def start_guild_loops() -> None:
+    global guild_loop_semaphore
+    if not guild_loop_semaphore:
+        concurrency = int(yaml_get(yaml["loop"], "concurrency", 10))
+        logging.info("Running the loop for up to %s guilds at once", concurrency)
+        guild_loop_semaphore = asyncio.Semaphore(concurrency)
+
+    # Each guild gets a fixed offset so REST calls are spread over the interval
+    jitter = yaml_get(yaml["loop"], "jitter")
+    jitter = string_to_timedelta(jitter).total_seconds() if jitter else loop_interval() / 2
+
+    for guild in client.guilds:
+        if not owns_guild(guild.id): continue
+        if guild.id in guild_loops:
+            logging.warning("Loop for '%s' is still running, skipping", guild)
+            metrics.increment("loop.skipped")
+            continue
+        delay = random.Random(guild.id).random() * jitter
+        guild_loops[guild.id] = asyncio.create_task(run_guild_loop(guild, delay))
+
+    metrics.set("loop.running", len(guild_loops))
+
+async def run_guild_loop(guild: discord.Guild, delay: float) -> None:
+    try:
+        await asyncio.sleep(delay)
+        async with guild_loop_semaphore:
+            logging.info("Executing loop functions for: %s", guild)
+            await run_event("loop", None, None, guild, yaml["loop"], f"loop -> {guild.id} -> ", code_path="do")
+    except Exception as e:
+        logging.error("Loop for '%s' failed: %s", guild, e)
+        metrics.increment("loop.failed")
+    finally:
+        guild_loops.pop(guild.id, None)
+
+
 def start_loop() -> None:
     if "loop" not in yaml: return
+    if main_loop.is_running(): return
 
     for key in ["time", "interval", "every", "wait", "delay"]:
         if key not in yaml["loop"]: continue
@@ -1460,17 +3554,312 @@ def start_loop() -> None:
 
 
 
+# ---------- Shard Health ---------- #
+
+def shard_health() -> dict[int, dict]:
+    guild_counts: dict[int, int] = {}
+    for guild in client.guilds:
+        guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+
+    if isinstance(client, discord.AutoShardedClient):
+        shards = [(shard.id, shard.latency, shard.is_closed(), shard.is_ws_ratelimited()) for shard in client.shards.values()]
+    else:
+        shards = [(client.shard_id or 0, client.latency, client.is_closed(), client.is_ws_ratelimited())]
+
+    return {
+        shard_id: {
+            "latency": latency,
+            "closed": closed,
+            "rate limited": rate_limited,
+            "guilds": guild_counts.get(shard_id, 0)
+        }
+        for shard_id, latency, closed, rate_limited in shards
+    }
+
+@tasks.loop(minutes=1)
+async def report_health() -> None:
+    for shard_id, health in shard_health().items():
+        logging.info("Shard %s health: %s", shard_id, health)
+        metrics.set(f"shard.{shard_id}.latency", health["latency"])
+        metrics.set(f"shard.{shard_id}.closed", int(health["closed"]))
+        metrics.set(f"shard.{shard_id}.rate_limited", int(health["rate limited"]))
+        metrics.set(f"shard.{shard_id}.guilds", health["guilds"])
+    metrics.save()
+
+def start_health_report() -> None:
+    if report_health.is_running(): return
+    interval = yaml_get(sharding, "health interval")
+    if interval:
+        td = string_to_timedelta(interval)
+        report_health.change_interval(seconds=td.total_seconds())
+        logging.info("Changed health report interval seconds: %s", td.total_seconds())
+    report_health.start()
+
+
+@client.event
+async def on_shard_ready(shard_id: int): logging.info("Shard ready: %s", shard_id)
+
+@client.event
+async def on_shard_disconnect(shard_id: int):
+    logging.warning("Shard disconnected: %s", shard_id)
+    metrics.increment(f"shard.{shard_id}.disconnects")
+
+@client.event
+async def on_shard_resumed(shard_id: int): logging.info("Shard resumed: %s", shard_id)
+
+
+
+
+
+# ---------- Watchdog ---------- #
+
+# A tick on the event loop measures how late it wakes up. A thread notices when the loop
+# stops ticking and looks at what the loop is running at that moment, so the log names
+# the execution path that blocked it rather than whatever runs after it.
+class Watchdog:
+    def __init__(self, tick: float = 0.1, threshold: float = 0.25) -> None:
+        self.tick = tick
+        self.threshold = threshold
+        self.last_tick = time.monotonic()
+        self.blocked_in: str = None
+        self.task: asyncio.Task = None
+        self.loop_thread: int = None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.tick)
+            lag = max(0.0, loop.time() - start - self.tick)
+            self.last_tick = time.monotonic()
+            metrics.observe("loop.lag", lag)
+            if math.isfinite(client.latency): metrics.set("gateway.latency", client.latency)
+
+            if lag >= self.threshold:
+                metrics.increment("loop.blocked")
+                logging.warning("Event loop was blocked for %.3fs in: %s", lag, self.blocked_in or "unknown")
+            self.blocked_in = None
+
+    def monitor(self) -> None:
+        while True:
+            time.sleep(self.tick)
+            if self.blocked_in: continue
+            if time.monotonic() - self.last_tick - self.tick < self.threshold: continue
+            self.blocked_in = self.current_path()
+            logging.warning("Event loop is blocked in: %s", self.blocked_in)
+
+    # The innermost object on the loop thread's stack that knows its execution path
+    def current_path(self) -> str:
+        frame = sys._current_frames().get(self.loop_thread)
+        location = None
+        while frame:
+            if not location: location = f"{frame.f_code.co_filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+            try:
+                path = getattr(frame.f_locals.get("self"), "execution_path", None)
+            except Exception:
+                path = None
+            if path: return f"{path} at {location}"
+            frame = frame.f_back
+        return location or "unknown"
+
+    def start(self) -> None:
+        import threading
+        if self.task: return
+        logging.info("Starting watchdog: tick %ss, threshold %ss", self.tick, self.threshold)
+        self.loop_thread = threading.get_ident()
+        # The tick from when the module was loaded would look like the loop was blocked since
+        self.last_tick = time.monotonic()
+        self.task = asyncio.ensure_future(self.run())
+        threading.Thread(target=self.monitor, name="watchdog", daemon=True).start()
+
+
+# Tick and threshold are in seconds, 'watchdog: false' turns it off
+watchdog_settings = yaml.get("watchdog", {})
+watchdog: Watchdog = None
+if watchdog_settings is not False:
+    if not isinstance(watchdog_settings, dict): watchdog_settings = {}
+    watchdog = Watchdog(float(watchdog_settings.get("tick", 0.1)), float(watchdog_settings.get("threshold", 0.25)))
+
+
+
+
+
+# ---------- Cluster ---------- #
+
+def shard_ranges() -> list[list[int]]:
+    ids = list(range(shard_count))
+    return [ids[i * shard_count // worker_processes:(i + 1) * shard_count // worker_processes] for i in range(worker_processes)]
+
+def start_worker(ids: list[int]) -> subprocess.Popen:
+    logging.info("Starting worker for shards: %s", ids)
+    env = os.environ.copy()
+    env[SHARD_IDS_ENV] = ",".join(str(x) for x in ids)
+    env[SHARD_COUNT_ENV] = str(shard_count)
+    return subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), *sys.argv[1:]], env=env)
+
+def data_file(ids: list[int]) -> str:
+    return f"data.shards-{ids[0]}-{ids[-1]}.json"
+
+def shard_of(guild_id: int) -> int:
+    return (guild_id >> 22) % shard_count if guild_id else 0
+
+# Timers and bulk updates are split over the workers again before they start, so changing the
+# number of processes or shards leaves nothing in a file no worker reads. Saved messages are
+# looked up by execution path and not by guild, every worker gets all of them
+def redistribute_data() -> None:
+    files = {data_file(ids): ids for ids in shard_ranges()}
+    messages, timers, bulk = {}, [], {}
+    previous: dict[str, dict] = {}
+    for path in sorted(glob.glob("data.shards-*.json")):
+        try:
+            with open(path) as f:
+                previous[path] = json.load(f)
+        except Exception as e:
+            logging.warn("Could not read '%s': %s", path, e)
+
+    for data in [save_data.data, *previous.values()]:
+        messages.update(data.pop("messages", {}))
+        timers += data.pop("timers", [])
+        bulk.update(data.pop("bulk", {}))
+
+    # Variables that workers saved before they were shared are moved to the parent
+    for data in previous.values():
+        for scope, keys in data.pop("variables", {}).items():
+            if scope not in variables.values: continue
+            for key, values in keys.items():
+                variables.values[scope].setdefault(key, {}).update({name: value for name, value in values.items() if name in variables.scopes})
+
+    # Everything else, like the app command hashes of the primary worker, stays with the file
+    # or goes to the new file of the worker owning shard 0 when the old file is removed
+    primary = next((data for path, data in previous.items() if path.startswith("data.shards-0-")), {})
+    for path, ids in files.items():
+        logging.info("Writing data of shards %s: %s", ids, path)
+        data = {**(primary if 0 in ids else {}), **previous.get(path, {})}
+        data["messages"] = messages
+        data["timers"] = [x for x in timers if shard_of(x.get("guild")) in ids]
+        data["bulk"] = {key: x for key, x in bulk.items() if shard_of(x.get("guild")) in ids}
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(path + ".tmp", path)
+    for path in previous:
+        if path in files: continue
+        logging.info("Removing data of a previous cluster: %s", path)
+        os.remove(path)
+
+    save_data.save()
+
+# The parent process does not connect, it only starts and watches the workers.
+# A worker that keeps crashing is restarted after a delay that doubles every time
+# until it stayed up for a minute
+def run_cluster() -> None:
+    logging.info("Starting cluster: %s shards on %s processes", shard_count, worker_processes)
+    restart = sharding.get("restart", True)
+    restart_delay = to_seconds(yaml_get(sharding, "restart delay", 5)) or 5
+    max_restart_delay = to_seconds(yaml_get(sharding, "max restart delay", 300)) or 300
+
+    redistribute_data()
+    variables.serve()
+    workers: dict[tuple, subprocess.Popen] = {}
+    started: dict[tuple, float] = {}
+    failures: dict[tuple, int] = {}
+    restart_at: dict[tuple, float] = {}
+    for ids in shard_ranges():
+        workers[tuple(ids)] = start_worker(ids)
+        started[tuple(ids)] = time.monotonic()
+
+    try:
+        while workers:
+            time.sleep(5)
+            now = time.monotonic()
+            for ids, process in list(workers.items()):
+                if process is None:
+                    if now < restart_at[ids]: continue
+                    workers[ids] = start_worker(list(ids))
+                    started[ids] = now
+                    continue
+
+                code = process.poll()
+                metrics.set(f"cluster.{ids[0]}-{ids[-1]}.alive", int(code is None))
+                if code is None: continue
+
+                logging.error("Worker for shards %s exited with code %s", list(ids), code)
+                metrics.increment("cluster.worker_exits")
+                if not restart or code == 0:
+                    del workers[ids]
+                    continue
+                failures[ids] = 0 if now - started[ids] > 60 else failures.get(ids, 0) + 1
+                delay = min(max_restart_delay, restart_delay * 2 ** failures[ids])
+                logging.info("Restarting worker for shards %s in %ss", list(ids), delay)
+                workers[ids] = None
+                restart_at[ids] = now + delay
+
+            with variables.lock: variables.flush()
+            metrics.save()
+    except KeyboardInterrupt:
+        logging.info("Stopping cluster")
+        for process in workers.values():
+            if process: process.terminate()
+        for process in workers.values():
+            if process: process.wait()
+    with variables.lock: variables.flush()
+
+
+
 @client.event
-async def on_connect(): logging.log("Connected")
+async def on_connect(): logging.info("Connected")
 
 @client.event
-async def on_disconnect(): logging.log("Disonnected")
+async def on_disconnect(): logging.info("Disonnected")
 
 @client.event
-async def on_resumed(): logging.log("Resumed")
+async def on_resumed(): logging.info("Resumed")
 
 
-logging.info("Starting client")
-client.run(TOKEN)
+# ---------- Register Events ---------- #
+
+# Only listen to the events the YAML has a section for
+EVENT_LISTENERS = {
+    "on message": on_message,
+    "on user joined": on_member_join,
+    "on user left": on_member_remove,
+}
+
+def register_events() -> None:
+    client.event(on_ready)
+    for section, listener in EVENT_LISTENERS.items():
+        if not has_section(section):
+            logging.info("Not listening to '%s'", section)
+            continue
+        logging.info("Listening to '%s'", section)
+        client.event(listener)
+
+register_events()
+end_phase("setup")
+
+
+# Logs in without connecting to the gateway and prints how long each phase took
+async def startup_report() -> None:
+    try:
+        await client.login(TOKEN)
+    except Exception as e:
+        logging.error("Login failed: %s", e)
+        print(f"Login failed: {e}")
+    end_phase("login")
+    await client.close()
+
+    print("Startup report:")
+    for name, seconds in startup_phases.items():
+        print(f"  {name:<12} {seconds * 1000:>9.1f} ms")
+    print(f"  {'total':<12} {sum(startup_phases.values()) * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    if "--startup-report" in sys.argv:
+        asyncio.run(startup_report())
+    elif is_cluster_parent:
+        run_cluster()
+    else:
+        logging.info("Starting client")
+        client.run(TOKEN)
 
 
@@ -0,0 +1,67 @@
+# Memory allocated while handling one event, measured with tracemalloc
+# Usage: python benchmarks/bench_alloc.py [events]
+import os, sys, tempfile, asyncio, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("""
+variables:
+  count: 0
+on message:
+  - set variable: {count: count + 1, evaluate: true}
+  - condition:
+      if: "count % 2 == 0"
+      do:
+        - add role: {roles: [Role 1]}
+      else:
+        - remove role: {roles: [Role 1]}
+  - send message:
+      content:
+        - text: "Hello {user.name}, message {count}"
+        - embed:
+            title: "{guild.name}"
+            description: "{guild.member_count} members"
+            fields:
+              - {name: Count, value: "{count}"}
+""")
+
+import gc, logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def main() -> None:
+    fake_client.populate(Main.client, guilds=1, members=20)
+    guild = Main.client.guilds[0]
+    messages = [fake_client.make_message(Main.client, guild.text_channels[0], fake_client.make_member(Main.client, guild, i % 20)) for i in range(EVENTS)]
+
+    # Warm up caches and lazily created objects
+    for message in messages[:10]:
+        await Main.on_message(message)
+        await Main.dispatcher.join()
+
+    gc.collect()
+    tracemalloc.start()
+    total_peak = 0
+    start_current, _ = tracemalloc.get_traced_memory()
+    for message in messages:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await Main.on_message(message)
+        await Main.dispatcher.join()
+        _, peak = tracemalloc.get_traced_memory()
+        total_peak += peak - before
+    end_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{EVENTS} events: {total_peak / EVENTS:>10.0f} B peak allocated per event  {(end_current - start_current) / EVENTS:>8.0f} B retained per event")
+
+asyncio.run(main())
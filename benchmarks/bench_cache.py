@@ -0,0 +1,76 @@
+# Memory used by the gateway caches at 1k guilds with different cache policies
+# Usage: python benchmarks/bench_cache.py [guilds] [members per guild]
+import os, sys, tempfile, tracemalloc, gc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+GUILDS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+MEMBERS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+MESSAGES = 10 # Messages received per guild
+ONLINE = 5 # Members sent in GUILD_CREATE for guilds that are not chunked
+
+# Main loads the YAML from the working directory
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("on user joined:\n  - add role: Member\n")
+
+import discord
+import Main
+
+
+def user_payload(user_id: int) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None}
+
+def member_payload(user_id: int) -> dict:
+    return {"user": user_payload(user_id), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0}
+
+def guild_payload(guild_id: int, members: int) -> dict:
+    return {
+        "id": str(guild_id),
+        "name": f"Guild {guild_id}",
+        "owner_id": "1",
+        "member_count": MEMBERS,
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": str(guild_id + 1), "type": 0, "name": "general", "position": 0, "permission_overwrites": []}],
+        "members": [member_payload(guild_id * 1000 + i) for i in range(members)],
+        "emojis": [],
+        "stickers": [],
+        "features": []
+    }
+
+def message_payload(message_id: int, channel_id: int, author_id: int) -> dict:
+    return {
+        "id": str(message_id), "channel_id": str(channel_id), "author": user_payload(author_id),
+        "content": "hello", "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+        "attachments": [], "embeds": [], "pinned": False, "type": 0
+    }
+
+
+def measure(name: str, options: dict) -> None:
+    gc.collect()
+    tracemalloc.start()
+    client = discord.Client(intents=Main.intents, **options)
+    state = client._connection
+    members = MEMBERS if options["chunk_guilds_at_startup"] else ONLINE
+
+    for index in range(GUILDS):
+        guild_id = (index + 1) << 22
+        guild = state._add_guild_from_data(guild_payload(guild_id, members))
+        if state._messages is None: continue
+        channel = guild.text_channels[0]
+        for i in range(MESSAGES):
+            state._messages.append(discord.Message(state=state, channel=channel, data=message_payload(guild_id + i, channel.id, guild_id * 1000)))
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<28} {current / 1024 / 1024:>8.1f} MiB {current // GUILDS:>10} B/guild {peak / 1024 / 1024:>8.1f} MiB peak")
+    del client, state
+
+
+print(f"{GUILDS} guilds, {MEMBERS} members per guild, {MESSAGES} messages per guild")
+measure("discord.py defaults", Main.cache_options(None, Main.intents))
+measure("cache: auto", Main.cache_options({}, Main.intents))
+measure("cache: members none", Main.cache_options({"members": "none"}, Main.intents))
+measure("cache: messages 5000", Main.cache_options({"messages": 5000, "chunk at startup": True}, Main.intents))
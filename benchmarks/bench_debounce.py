@@ -0,0 +1,64 @@
+# Edits and saves made by a member counter message during a join wave, with and without debounce
+# Usage: python benchmarks/bench_debounce.py [joins] [joins per second]
+import os, sys, tempfile, time, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+JOINS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+RATE = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("""
+variables:
+  joins: 0
+on user joined:
+  - set variable: {joins: joins + 1, evaluate: true}
+  - update message:
+      channel: channel-0
+      content: "Members joined: {joins}"
+      debounce: {quiet: 1s, max wait: 3s}
+""")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def run(debounce: bool) -> None:
+    arguments = Main.yaml["on user joined"][1]["update message"]
+    if not debounce: arguments.pop("debounce", None)
+    Main.dispatcher = Main.Dispatcher(guild_limit=1)
+    Main.save_data.data["messages"] = {}
+    Main.variables.values["global"].clear()
+    http = fake_client.populate(Main.client, guilds=1, members=0, latency=0.02)
+    guild = Main.client.guilds[0]
+
+    saves = 0
+    save = Main.save_data.save
+    def counted_save() -> None:
+        nonlocal saves
+        saves += 1
+        save()
+    Main.save_data.save = counted_save
+
+    start = time.perf_counter()
+    for i in range(JOINS):
+        await Main.on_member_join(fake_client.make_member(Main.client, guild, i))
+        await asyncio.sleep(1 / RATE)
+    await Main.dispatcher.join()
+    await Main.message_debouncer.join()
+    elapsed = time.perf_counter() - start
+    Main.save_data.save = save
+
+    edits = http.calls["edit_message"] + http.calls["send_message"]
+    print(f"debounce={str(debounce):<5} {edits:>5} edits ({edits / elapsed:>6.1f}/s)  {http.calls['get_message']:>5} fetches  {saves:>5} saves  last content: {list(http.messages.values())[-1]['content']!r}")
+
+
+print(f"{JOINS} joins at {RATE:.0f}/s")
+asyncio.run(run(True))
+asyncio.run(run(False))
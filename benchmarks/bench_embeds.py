@@ -0,0 +1,54 @@
+# Time to send a message with a static and a variable driven embed
+# Usage: python benchmarks/bench_embeds.py [messages]
+import os, sys, tempfile, time, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+FIELDS = "\n".join(f"""              - {{name: "Rule {i}", value: "Rule number {i} of {{rules}}, {{round(price * {i} * 1.1, 2)}} coins"}}""" for i in range(15))
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write(f"""
+variables:
+  rules: 15
+  price: 3
+  sent: 0
+on message:
+  - set variable: {{sent: sent + 1, evaluate: true}}
+  - send message:
+      content:
+        - embed:
+            title: Rules
+            description: "There are {{rules}} rules"
+            fields:
+{FIELDS}
+            footer: "Prices are {{price}} coins"
+""")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def main() -> None:
+    fake_client.populate(Main.client, guilds=1, members=5)
+    guild = Main.client.guilds[0]
+    member = fake_client.make_member(Main.client, guild, 0)
+    messages = [fake_client.make_message(Main.client, guild.text_channels[0], member) for _ in range(MESSAGES)]
+
+    start = time.perf_counter()
+    for message in messages:
+        await Main.on_message(message)
+        await Main.dispatcher.join()
+    elapsed = time.perf_counter() - start
+
+    counters = Main.metrics.counters
+    print(f"{MESSAGES} messages: {elapsed / MESSAGES * 1000:.3f} ms per message, embeds built {counters.get('embeds.built', MESSAGES)}, reused {counters.get('embeds.cached', 0)}")
+
+asyncio.run(main())
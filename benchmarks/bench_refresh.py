@@ -0,0 +1,57 @@
+# Cost of Function.refresh per component click compared to re-resolving through the get_* resolvers
+# Usage: python benchmarks/bench_refresh.py [clicks] [REST latency in seconds]
+import os, sys, tempfile, time, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CLICKS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("on user joined:\n  - send message: hi\n")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+# Every click resolves like the first one, otherwise the resolver cache answers after the first click
+async def resolve(func: Main.Function) -> None:
+    Main.resolver_cache.entries.clear()
+    func.guild = await func.get_server(func.guild.id)
+    func.channel = await func.get_channel(func.channel.id)
+    func.user = await func.get_user(func.user.id)
+
+async def refresh(func: Main.Function) -> None:
+    await func.refresh()
+
+
+async def measure(name: str, click, cached_user: bool) -> None:
+    http = fake_client.populate(Main.client, guilds=10, members=50, latency=LATENCY)
+    guild = Main.client.guilds[0]
+    # In a guild that is not chunked the clicking user may only be known from the interaction
+    user = guild.members[1]
+    if not cached_user:
+        guild._member_count = 1000
+        user = fake_client.make_member(Main.client, guild, 999)
+    func = Main.Function({"send message": "hi"}, guild.text_channels[0], user, guild, "bench")
+
+    start = time.perf_counter()
+    for _ in range(CLICKS): await click(func)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<34} {elapsed / CLICKS * 1e6:>9.1f} us/click  {sum(http.calls.values()) / CLICKS:>5.2f} REST calls/click")
+
+
+async def main() -> None:
+    print(f"{CLICKS} clicks, {LATENCY * 1000:.0f} ms REST latency")
+    await measure("resolvers, member cached", resolve, True)
+    await measure("resolvers, member not cached", resolve, False)
+    await measure("refresh, member cached", refresh, True)
+    await measure("refresh, member not cached", refresh, False)
+
+asyncio.run(main())
@@ -0,0 +1,69 @@
+# Click latency and allocations when a menu with a conditional item is rendered again
+# Usage: python benchmarks/bench_rerender.py [clicks]
+import os, sys, tempfile, time, asyncio, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CLICKS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+FIELDS = "\n".join(f"""              - {{name: "Item {i}", value: "Costs {{price * {i}}} coins"}}""" for i in range(10))
+BUTTONS = "\n".join(f"""        - button: {{label: "Option {i}", on interaction: []}}""" for i in range(4))
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write(f"""
+variables:
+  page: 0
+  price: 3
+on message:
+  - send message:
+      content:
+        - embed:
+            title: Shop
+            description: "Everything costs {{price}} coins"
+            fields:
+{FIELDS}
+        - embed: {{title: Rules, description: "Be nice"}}
+        - condition:
+            if: "page % 2 == 0"
+            do:
+              text: "Page {{page}} (even)"
+            else:
+              text: "Page {{page}} (odd)"
+        - button:
+            label: Next
+            on interaction:
+              - set variable: {{page: page + 1, evaluate: true}}
+{BUTTONS}
+""")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def main() -> None:
+    fake_client.populate(Main.client, guilds=1, members=5)
+    guild = Main.client.guilds[0]
+    member = fake_client.make_member(Main.client, guild, 0)
+    await Main.on_message(fake_client.make_message(Main.client, guild.text_channels[0], member))
+    await Main.dispatcher.join()
+    button = next(x for x in Main.interactions if x.execution_path.endswith("button"))
+    created = len(Main.interactions)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(CLICKS):
+        tracemalloc.reset_peak()
+        await button.interact(fake_client.FakeInteraction(Main.client, guild.text_channels[0], member))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{CLICKS} clicks: {elapsed / CLICKS * 1000:.3f} ms per click, peak {peak / 1024:.0f} KiB, {len(Main.interactions) - created} interactions created")
+
+asyncio.run(main())
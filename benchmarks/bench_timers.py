@@ -0,0 +1,52 @@
+# Time to catch up on timers that expired while the bot was offline
+# Usage: python benchmarks/bench_timers.py [timers] [guilds] [REST latency]
+import os, sys, tempfile, time, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TIMERS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+GUILDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+LATENCY = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("""
+on message:
+  - wait:
+      time: 1m
+      do:
+        - send message: "Reminder"
+""")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def main() -> None:
+    http = fake_client.populate(Main.client, guilds=GUILDS, members=20, latency=LATENCY)
+    expired = (Main.utcnow() - Main.timedelta(hours=1)).isoformat()
+    # Users are not in the cache (no members intent) so every distinct one is a REST lookup
+    Main.save_data.data["timers"] = [
+        {
+            "func": f"on message -> wait {index}",
+            "channel": guild.text_channels[0].id,
+            "user": fake_client.member_id(guild.id, index % 20),
+            "guild": guild.id,
+            "time": expired,
+            "do": [{"send message": "Reminder"}]
+        }
+        for index in range(TIMERS)
+        for guild in [Main.client.guilds[index % GUILDS]]
+    ]
+
+    start = time.perf_counter()
+    await Main.check_timers()
+    elapsed = time.perf_counter() - start
+    print(f"{TIMERS} timers in {GUILDS} guilds: {elapsed:.2f}s, {len(Main.save_data.get_timers())} left, REST {dict(http.calls)}")
+
+asyncio.run(main())
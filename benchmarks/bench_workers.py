@@ -0,0 +1,64 @@
+# Throughput and loop lag of eval heavy message handlers with and without render workers
+# Usage: python benchmarks/bench_workers.py [events] [workers]
+import os, sys, tempfile, time, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 2
+
+os.chdir(tempfile.mkdtemp())
+with open("bench.yaml", "w") as f:
+    f.write("""
+variables:
+  greeting: Welcome
+on message:
+  - send message:
+      content:
+        - text: "{greeting} {user.display_name}"
+        - embed:
+            title: "Stats for {guild.name}"
+            description: "{sum(i * i for i in range(20000))}"
+            fields:
+""" + "".join(f"""
+              - name: "Field {i} for {{user.name}}"
+                value: "{{sum(i * i for i in range(20000)) % {i + 7}}}"
+""" for i in range(10)))
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+
+
+async def run(workers: int) -> None:
+    Main.render_workers = workers
+    Main.dispatcher = Main.Dispatcher(global_limit=EVENTS, guild_limit=EVENTS)
+    http = fake_client.populate(Main.client, guilds=20, members=20, latency=0.05)
+    guilds = Main.client.guilds
+    messages = [
+        fake_client.make_message(Main.client, guild.text_channels[0], fake_client.make_member(Main.client, guild, i % 20))
+        for i, guild in ((i, guilds[i % len(guilds)]) for i in range(EVENTS))
+    ]
+    if workers:
+        await asyncio.gather(*(Main.on_message(message) for message in messages[:workers]))
+        await Main.dispatcher.join()
+
+    async with fake_client.LagProbe() as probe:
+        start = time.perf_counter()
+        await asyncio.gather(*(Main.on_message(message) for message in messages))
+        await Main.dispatcher.join()
+        elapsed = time.perf_counter() - start
+
+    print(f"workers={workers:<3} {EVENTS / elapsed:>8.1f} events/s  max loop lag {probe.max_lag * 1000:>8.1f} ms  REST calls {sum(http.calls.values())}")
+
+
+# Worker processes import this file again, only the parent runs the benchmark
+if __name__ == "__main__":
+    print(f"{EVENTS} on message events, {WORKERS} workers")
+    asyncio.run(run(0))
+    asyncio.run(run(WORKERS))
+    if Main.render_pool: Main.render_pool.shutdown()
@@ -0,0 +1,248 @@
+# Offline stand-in for Discord used by the benchmarks
+# populate() fills a client's gateway caches with generated guilds and
+# FakeHTTP answers the REST calls locally while counting them
+import asyncio, json, itertools, time
+from collections import Counter
+from types import SimpleNamespace
+import discord
+
+
+BOT_ID = 1 << 22
+TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+ids = itertools.count(1 << 40)
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "bot": bot}
+
+def member_payload(user_id: int, roles: list[int] = []) -> dict:
+    return {"user": user_payload(user_id), "roles": [str(x) for x in roles], "joined_at": TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+
+def role_payload(role_id: int, name: str, position: int = 0) -> dict:
+    return {"id": str(role_id), "name": name, "permissions": "0", "position": position, "color": 0, "hoist": False, "managed": False, "mentionable": False}
+
+def channel_payload(channel_id: int, guild_id: int, name: str) -> dict:
+    return {"id": str(channel_id), "guild_id": str(guild_id), "type": 0, "name": name, "position": 0, "permission_overwrites": []}
+
+def guild_payload(guild_id: int, members: int, channels: int = 1, roles: int = 2, member_count: int = None) -> dict:
+    return {
+        "id": str(guild_id),
+        "name": f"Guild {guild_id}",
+        "owner_id": str(BOT_ID),
+        "member_count": member_count or members,
+        "roles": [role_payload(guild_id, "@everyone")] + [role_payload(guild_id + i, f"Role {i}", i) for i in range(1, roles)],
+        "channels": [channel_payload(guild_id + 100 + i, guild_id, f"channel-{i}") for i in range(channels)],
+        "members": [member_payload(BOT_ID)] + [member_payload(member_id(guild_id, i)) for i in range(members)],
+        "emojis": [],
+        "stickers": [],
+        "features": []
+    }
+
+def message_payload(message_id: int, channel_id: int, author: dict, content: str = "", embeds: list = [], components: list = []) -> dict:
+    return {
+        "id": str(message_id), "channel_id": str(channel_id), "author": author,
+        "content": content, "timestamp": TIMESTAMP, "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+        "attachments": [], "embeds": embeds, "components": components, "pinned": False, "type": 0
+    }
+
+def guild_id(index: int) -> int:
+    return (index + 1) << 32
+
+def member_id(guild_id: int, index: int) -> int:
+    return guild_id + 1000 + index
+
+
+def not_found(what: str) -> discord.NotFound:
+    return discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), f"Unknown {what}")
+
+
+class FakeHTTP:
+    def __init__(self, state, latency: float = 0.0) -> None:
+        self.state = state
+        self.latency = latency
+        self.calls = Counter()
+        self.uploaded = 0
+        self.messages: dict[int, dict] = {}
+        # IDs that REST answers with NotFound, members and users are otherwise assumed to exist
+        self.missing: set[int] = set()
+
+    async def request(self, name: str) -> None:
+        self.calls[name] += 1
+        if self.latency: await asyncio.sleep(self.latency)
+
+    def payload(self, params) -> dict:
+        if params.payload is not None: return params.payload
+        return json.loads(params.multipart[0]["value"])
+
+    # Uploaded files get a signed CDN URL, embeds linking them with attachment:// get it too
+    def upload(self, channel_id, params, payload: dict) -> list[dict]:
+        uploaded = []
+        for file in params.files or []:
+            self.uploaded += file.fp.seek(0, 2)
+            url = f"https://cdn.discordapp.com/attachments/{channel_id}/{next(ids)}/{file.filename}?ex={int(time.time()) + 86400:x}"
+            uploaded.append({"id": str(next(ids)), "filename": file.filename, "size": file.fp.tell(), "url": url, "proxy_url": url})
+            for embed in payload.get("embeds", []):
+                for key in ["image", "thumbnail"]:
+                    if embed.get(key, {}).get("url") == file.uri: embed[key]["url"] = url
+        return uploaded
+
+    async def send_message(self, channel_id, *, params) -> dict:
+        await self.request("send_message")
+        payload = self.payload(params)
+        uploaded = self.upload(channel_id, params, payload)
+        data = message_payload(next(ids), channel_id, user_payload(BOT_ID, True), payload.get("content") or "", payload.get("embeds", []), payload.get("components", []))
+        # Files used by an embed are not listed as attachments
+        embedded = [embed[key]["url"] for embed in payload.get("embeds", []) for key in ["image", "thumbnail"] if key in embed]
+        data["attachments"] = [attachment for attachment in uploaded if attachment["url"] not in embedded]
+        self.messages[int(data["id"])] = data
+        return data
+
+    async def edit_message(self, channel_id, message_id, *, params) -> dict:
+        await self.request("edit_message")
+        data = self.messages.get(int(message_id)) or message_payload(message_id, channel_id, user_payload(BOT_ID, True))
+        data.update({key: value for key, value in self.payload(params).items() if key in ["content", "embeds", "components"]})
+        self.messages[int(message_id)] = data
+        return data
+
+    async def get_message(self, channel_id, message_id) -> dict:
+        await self.request("get_message")
+        if int(message_id) not in self.messages: raise not_found("Message")
+        return self.messages[int(message_id)]
+
+    # The gateway would send a member update after a role change
+    async def add_role(self, guild_id, user_id, role_id, *, reason=None) -> None:
+        await self.request("add_role")
+        guild = self.state._get_guild(int(guild_id))
+        member = guild.get_member(int(user_id)) if guild else None
+        if member and int(role_id) not in member._roles: member._roles.add(int(role_id))
+
+    async def remove_role(self, guild_id, user_id, role_id, *, reason=None) -> None:
+        await self.request("remove_role")
+        guild = self.state._get_guild(int(guild_id))
+        member = guild.get_member(int(user_id)) if guild else None
+        if member and int(role_id) in member._roles: member._roles.remove(int(role_id))
+
+    async def get_member(self, guild_id, user_id) -> dict:
+        await self.request("get_member")
+        guild = self.state._get_guild(int(guild_id))
+        if not guild or int(user_id) in self.missing: raise not_found("Member")
+        member = guild.get_member(int(user_id))
+        return member_payload(int(user_id), [role.id for role in member.roles[1:]] if member else [])
+
+    async def get_user(self, user_id) -> dict:
+        await self.request("get_user")
+        if int(user_id) in self.missing: raise not_found("User")
+        return user_payload(int(user_id))
+
+    async def get_channel(self, channel_id) -> dict:
+        await self.request("get_channel")
+        channel = self.state.get_channel(int(channel_id))
+        if not channel or int(channel_id) in self.missing: raise not_found("Channel")
+        return channel_payload(channel.id, channel.guild.id, channel.name)
+
+    async def get_guild(self, guild_id, *, with_counts=True) -> dict:
+        await self.request("get_guild")
+        guild = self.state._get_guild(int(guild_id))
+        if not guild or int(guild_id) in self.missing: raise not_found("Guild")
+        return guild_payload(guild.id, 0, 0)
+
+    # Everything else is counted and answered with nothing
+    def __getattr__(self, name: str):
+        async def call(*args, **kwargs) -> None:
+            await self.request(name)
+        return call
+
+
+def populate(client: discord.Client, guilds: int = 10, members: int = 50, channels: int = 1, latency: float = 0.0) -> FakeHTTP:
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data=user_payload(BOT_ID, True))
+    http = FakeHTTP(state, latency)
+    client.http = state.http = http
+    for index in range(guilds):
+        state._add_guild_from_data(guild_payload(guild_id(index), members, channels))
+    return http
+
+def make_message(client: discord.Client, channel: discord.TextChannel, author: discord.Member, content: str = "hello") -> discord.Message:
+    data = message_payload(next(ids), channel.id, user_payload(author.id), content)
+    data["guild_id"] = str(channel.guild.id)
+    data["member"] = {key: value for key, value in member_payload(author.id).items() if key != "user"}
+    return discord.Message(state=client._connection, channel=channel, data=data)
+
+def make_member(client: discord.Client, guild: discord.Guild, index: int) -> discord.Member:
+    return discord.Member(data=member_payload(member_id(guild.id, index)), guild=guild, state=client._connection)
+
+
+# Enough of discord.Interaction for Interaction.interact, responses are counted as REST calls
+class FakeResponse:
+    def __init__(self, http: FakeHTTP) -> None:
+        self.http = http
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def respond(self, name: str) -> None:
+        if self.done: raise discord.InteractionResponded(None)
+        self.done = True
+        await self.http.request(name)
+
+    async def defer(self, **kwargs) -> None:
+        await self.respond("defer")
+
+    async def send_message(self, *args, **kwargs) -> None:
+        await self.respond("interaction_response")
+
+    async def edit_message(self, **kwargs) -> None:
+        await self.respond("interaction_edit")
+
+class FakeFollowup:
+    def __init__(self, http: FakeHTTP) -> None:
+        self.http = http
+
+    async def send(self, *args, **kwargs) -> None:
+        await self.http.request("followup")
+
+class FakeInteraction:
+    def __init__(self, client: discord.Client, channel: discord.TextChannel, user: discord.Member, values: list = None, message: discord.Message = None) -> None:
+        self.http = client.http
+        self.message = message
+        self.channel = channel
+        self.guild = channel.guild if channel else None
+        self.user = user
+        self.data = {"values": values} if values else {}
+        self.extras = {}
+        self.response = FakeResponse(client.http)
+        self.followup = FakeFollowup(client.http)
+
+    def is_expired(self) -> bool:
+        return False
+
+    async def edit_original_response(self, **kwargs) -> None:
+        await self.http.request("edit_original_response")
+
+
+# Measures how late the loop wakes up, which is what a heartbeat would see
+class LagProbe:
+    def __init__(self, tick: float = 0.005) -> None:
+        self.tick = tick
+        self.max_lag = 0.0
+        self.task = None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.tick)
+            self.max_lag = max(self.max_lag, loop.time() - start - self.tick)
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.run())
+        await asyncio.sleep(0)
+        return self
+
+    # Give the probe one more tick to see the last stall
+    async def __aexit__(self, *args) -> None:
+        await asyncio.sleep(self.tick * 2)
+        self.task.cancel()
@@ -0,0 +1,119 @@
+# Plays a recording made with the recording: section against a config on the fake client
+# Usage: python benchmarks/replay.py <recording.jsonl> <config.yaml> [speed] [REST latency]
+# speed is a multiplier of the recorded pace or "max" to send everything at once
+import os, re, sys, shutil, tempfile, time, asyncio, json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if len(sys.argv) < 3:
+    print("Usage: python benchmarks/replay.py <recording.jsonl> <config.yaml> [speed] [REST latency]")
+    sys.exit(1)
+
+RECORDING = os.path.abspath(sys.argv[1])
+CONFIG = os.path.abspath(sys.argv[2])
+SPEED = sys.argv[3] if len(sys.argv) > 3 else "1"
+LATENCY = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+
+with open(RECORDING) as f:
+    records = [json.loads(line) for line in f if line.strip()]
+
+# The bot reads its config from the working directory and writes its data there
+os.chdir(tempfile.mkdtemp())
+shutil.copy(CONFIG, "replay.yaml")
+
+import logging
+import Main
+import fake_client
+
+logging.disable(logging.CRITICAL)
+# A replay of a recording should not record itself
+Main.recorder.path = None
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def main() -> None:
+    # Guilds in interaction paths are numbered like the guilds of events
+    path_guilds = [int(x) for record in records for x in re.findall(r"<guild (\d+)>", record.get("p", ""))]
+    guilds = max([record.get("g", 0) for record in records] + path_guilds + [0]) + 1
+    members = max([record.get("u", 0) for record in records] + [0]) + 1
+    channels = max([record.get("c", 0) for record in records] + [0]) + 1
+    http = fake_client.populate(Main.client, guilds, members, channels, LATENCY)
+    client_guilds = Main.client.guilds
+
+    latencies: dict[str, list[float]] = {}
+    pending: list[asyncio.Task] = []
+    skipped = 0
+    current_event = ""
+
+    # Dispatched events are timed from the moment they are queued until their handler is done
+    submit = Main.dispatcher.submit
+    def timed_submit(guild_id, user_id, job_factory):
+        start = time.perf_counter()
+        event = current_event
+        async def job() -> None:
+            await job_factory()
+            latencies.setdefault(event, []).append(time.perf_counter() - start)
+        return submit(guild_id, user_id, job)
+    Main.dispatcher.submit = timed_submit
+
+    async def timed_interaction(interaction: Main.Interaction, fake: fake_client.FakeInteraction) -> None:
+        start = time.perf_counter()
+        await interaction.interact(fake)
+        latencies.setdefault("interaction", []).append(time.perf_counter() - start)
+
+    speed = None if SPEED == "max" else float(SPEED)
+    start = time.perf_counter()
+    for record in records:
+        if speed:
+            delay = record["t"] / speed - (time.perf_counter() - start)
+            if delay > 0: await asyncio.sleep(delay)
+
+        # Direct messages are not replayed, the fake client only has guilds.
+        # At high speeds interactions can come before the message with their button was sent
+        # and are skipped as well
+        if "g" not in record:
+            skipped += 1
+            continue
+
+        current_event = record["e"]
+        guild = client_guilds[record["g"]]
+        channel = guild.text_channels[record.get("c", 0)]
+        member = fake_client.make_member(Main.client, guild, record.get("u", 0))
+
+        match record["e"]:
+            case "message":
+                content = record.get("m", "x" * record.get("n", 0))
+                await Main.on_message(fake_client.make_message(Main.client, channel, member, content))
+            case "join": await Main.on_member_join(member)
+            case "remove": await Main.on_member_remove(member)
+            case "interaction":
+                # Buttons only exist once the message that has them was sent during the replay
+                path = re.sub(r"<guild (\d+)>", lambda x: str(client_guilds[int(x[1])].id), record["p"])
+                interaction = next((x for x in reversed(Main.interactions) if x.execution_path == path), None)
+                if not interaction:
+                    skipped += 1
+                    continue
+                if record.get("v") and hasattr(interaction.item, "_values"): interaction.item._values = record["v"]
+                pending.append(asyncio.ensure_future(timed_interaction(interaction, fake_client.FakeInteraction(Main.client, channel, member, record.get("v")))))
+            case _: skipped += 1
+
+    await Main.dispatcher.join()
+    await asyncio.gather(*pending)
+    await Main.message_debouncer.join()
+    elapsed = time.perf_counter() - start
+
+    handled = sum(len(x) for x in latencies.values())
+    print(f"Replayed {len(records)} events at {'max speed' if SPEED == 'max' else SPEED + 'x'} in {elapsed:.2f}s: {handled / elapsed:.0f} events/s, {skipped} skipped, {len(records) - skipped - handled} dropped")
+    for event, values in sorted(latencies.items()):
+        print(f"  {event:<12} {len(values):>6}  p50 {percentile(values, 50) * 1000:>8.2f} ms  p95 {percentile(values, 95) * 1000:>8.2f} ms  p99 {percentile(values, 99) * 1000:>8.2f} ms  max {max(values) * 1000:>8.2f} ms")
+    print(f"  REST calls   {sum(http.calls.values()):>6}  " + ", ".join(f"{name} {count}" for name, count in http.calls.most_common()))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,13 @@
+# Main reads its config from the working directory when it is imported,
+# so every case imports it in a new process with its own config
+import os, sys, subprocess, tempfile, textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(config: str, code: str) -> subprocess.CompletedProcess:
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "bot.yaml"), "w") as f:
+        f.write(textwrap.dedent(config))
+    script = f"import os, sys\nROOT = {ROOT!r}\nsys.path.insert(0, ROOT)\nimport Main\n" + textwrap.dedent(code)
+    return subprocess.run([sys.executable, "-c", script], cwd=directory, capture_output=True, text=True, timeout=60)
@@ -0,0 +1,70 @@
+import unittest
+from helpers import run
+
+
+class AppCommandTests(unittest.TestCase):
+    def test_optional_option_before_required(self):
+        result = run("""
+            app commands:
+              remind:
+                options:
+                  note:
+                    type: string
+                    required: false
+                  member: user
+                do:
+                  - send message: "{member}"
+        """, """
+            command = Main.tree.get_command("remind")
+            print([(x.name, x.required) for x in command.parameters])
+        """)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[('member', True), ('note', False)]", result.stdout)
+
+    def test_reserved_option_name(self):
+        result = run("""
+            app commands:
+              ping:
+                options:
+                  response: string
+                do:
+                  - send message: pong
+        """, "")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("'response' cannot be used as an option name", result.stderr)
+        self.assertIn("Trace: app commands -> ping -> options -> response", result.stderr)
+
+    def test_option_named_user_is_the_picked_member(self):
+        result = run("""
+            variables:
+              picked: 0
+            app commands:
+              greet:
+                options:
+                  user: user
+                do:
+                  - set variable:
+                      evaluate: true
+                      picked: user.id
+        """, """
+            import asyncio
+            sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+            import fake_client
+
+            async def main():
+                fake_client.populate(Main.client, guilds=1, members=2)
+                guild = Main.client.guilds[0]
+                runner = fake_client.make_member(Main.client, guild, 0)
+                picked = fake_client.make_member(Main.client, guild, 1)
+                interaction = fake_client.FakeInteraction(Main.client, guild.text_channels[0], runner)
+                await Main.run_app_command("greet", Main.app_command_settings["greet"], interaction, {"user": picked})
+                print(Main.variables.get("picked") == picked.id)
+
+            asyncio.run(main())
+        """)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("True", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from helpers import run
+
+
+# Runs the on message section once for a member of a generated guild
+ON_MESSAGE = """
+    import asyncio, json
+    sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+    import fake_client
+
+    async def main():
+        fake_client.populate(Main.client, guilds=1, members=2)
+        guild = Main.client.guilds[0]
+        member = fake_client.make_member(Main.client, guild, 0)
+        await Main.run_event("on message", guild.text_channels[0], member, guild)
+        Main.variables.flush()
+        print({name: Main.variables.get(name) for name in Main.variables.scopes})
+
+    asyncio.run(main())
+"""
+
+
+class VariableTests(unittest.TestCase):
+    def test_comprehensions_and_lambdas_see_variables(self):
+        result = run("""
+            variables:
+              values: [1, 2, 3]
+              threshold: 1
+              total: 0
+              above: []
+              filtered: []
+            on message:
+              - set variable:
+                  evaluate: true
+                  total: sum(v for v in values if v > threshold)
+                  above: "[v for v in values if v > threshold]"
+                  filtered: "list(filter(lambda v: v > threshold, values))"
+        """, ON_MESSAGE)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("'total': 5, 'above': [2, 3], 'filtered': [2, 3]", result.stdout)
+
+    def test_values_that_are_not_json_are_not_saved(self):
+        result = run("""
+            save variables: true
+            variables:
+              last_seen: never
+              count: 0
+            on message:
+              - set variable:
+                  evaluate: true
+                  last_seen: utcnow()
+                  count: count + 1
+        """, ON_MESSAGE + """
+    with open("data.json") as f:
+        print(json.load(f)["variables"]["global"])
+""")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("{'last_seen': 'never', 'count': 1}", result.stdout)
+        self.assertIn("{'global': {'count': 1}}", result.stdout)
+
+    def test_equal_values_of_other_types_are_rendered_again(self):
+        result = run("""
+            variables:
+              flag: 1
+        """, """
+            import asyncio
+            sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+            import fake_client
+
+            async def main():
+                fake_client.populate(Main.client, guilds=1, members=1)
+                guild = Main.client.guilds[0]
+                raw = {"send message": {"content": [{"embed": {"description": "{flag}"}}]}}
+                for value in [1, True, 1.0]:
+                    Main.variables.set("flag", value)
+                    message = Main.FunctionMessage(raw, guild.text_channels[0], None, guild)
+                    await message.find_arguments(message.raw_function["send message"])
+                    print(message.embed.description)
+
+            asyncio.run(main())
+        """)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("1\nTrue\n1.0", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()